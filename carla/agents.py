@@ -0,0 +1,118 @@
+"""
+Columnar logs of the non-player agents.
+
+extract_agents turns the repeated protobuf of measurements.non_player_agents
+into one numpy structured array per tick. AgentLog collects those arrays
+during an episode and writes them column by column, one raw file per field,
+through a sink. load_agent_log maps the files back as numpy arrays, so a whole
+episode can be queried with numpy operations.
+"""
+
+import os
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+
+VEHICLE = 0
+PEDESTRIAN = 1
+TRAFFIC_LIGHT = 2
+SPEED_LIMIT_SIGN = 3
+
+AGENT_TYPES = ['vehicle', 'pedestrian', 'traffic_light', 'speed_limit_sign']
+
+# value is the state of traffic lights and the speed limit of speed limit
+# signs. Traffic lights and signs have no bounding box.
+AGENT_DTYPE = numpy.dtype([
+    ('frame', '<u4'),
+    ('id', '<u4'),
+    ('type', 'u1'),
+    ('location', '<f4', (3,)),
+    ('rotation', '<f4', (3,)),
+    ('box_location', '<f4', (3,)),
+    ('box_rotation', '<f4', (3,)),
+    ('extent', '<f4', (3,)),
+    ('forward_speed', '<f4'),
+    ('value', '<f4')])
+
+_NO_BOX = ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0), (0.0, 0.0, 0.0))
+
+
+def _vector(v):
+    return v.x, v.y, v.z
+
+
+def _rotation(r):
+    return r.pitch, r.yaw, r.roll
+
+
+def _box(b):
+    return _vector(b.transform.location), _rotation(b.transform.rotation), _vector(b.extent)
+
+
+def _record(frame, agent):
+    kind = agent.WhichOneof('agent')
+    if kind == 'vehicle' or kind == 'pedestrian':
+        a = getattr(agent, kind)
+        return (frame, agent.id, VEHICLE if kind == 'vehicle' else PEDESTRIAN,
+                _vector(a.transform.location), _rotation(a.transform.rotation)) + \
+            _box(a.bounding_box) + (a.forward_speed, 0.0)
+    elif kind == 'traffic_light':
+        a = agent.traffic_light
+        return (frame, agent.id, TRAFFIC_LIGHT,
+                _vector(a.transform.location), _rotation(a.transform.rotation)) + _NO_BOX + (0.0, a.state)
+    a = agent.speed_limit_sign
+    return (frame, agent.id, SPEED_LIMIT_SIGN,
+            _vector(a.transform.location), _rotation(a.transform.rotation)) + _NO_BOX + (0.0, a.speed_limit)
+
+
+def extract_agents(measurements, frame=0):
+    """
+    Return the non-player agents of measurements as a structured array of
+    AGENT_DTYPE, tagged with the given frame.
+    """
+    return numpy.array(
+        [_record(frame, agent) for agent in measurements.non_player_agents],
+        dtype=AGENT_DTYPE)
+
+
+class AgentLog(object):
+    """
+    Collects the agent arrays of an episode and writes them as one raw file
+    per field of AGENT_DTYPE. The arrays are small (tens of agents per saved
+    frame), so they are kept in memory until the end of the episode.
+    """
+
+    def __init__(self):
+        self._arrays = []
+
+    def append(self, agents):
+        """Append a structured array of AGENT_DTYPE."""
+        self._arrays.append(agents)
+
+    def save(self, sink, key):
+        """Add the columns to sink as key/[field].bin, key without trailing slash."""
+        agents = numpy.concatenate(self._arrays) if self._arrays else numpy.zeros(0, dtype=AGENT_DTYPE)
+        for name in AGENT_DTYPE.names:
+            sink.add('%s/%s.bin' % (key, name), numpy.ascontiguousarray(agents[name]).tobytes())
+
+    def __len__(self):
+        return sum(len(agents) for agents in self._arrays)
+
+
+def load_agent_log(folder):
+    """
+    Return a dict of the memory-mapped columns of the agent log in folder,
+    every field of AGENT_DTYPE is a read-only numpy array.
+    """
+    columns = {}
+    for name in AGENT_DTYPE.names:
+        base, shape = AGENT_DTYPE[name].base, AGENT_DTYPE[name].shape
+        filename = os.path.join(folder, name + '.bin')
+        if os.path.getsize(filename) == 0:
+            columns[name] = numpy.zeros((0,) + shape, dtype=base)
+        else:
+            columns[name] = numpy.memmap(filename, dtype=base, mode='r').reshape((-1,) + shape)
+    return columns
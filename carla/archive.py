@@ -0,0 +1,186 @@
+"""
+Sharded tar archives for sensor data.
+
+Instead of one file per sensor and frame, encoded sensor data is appended to
+size-bounded tar shards. Every appended member is recorded in an index file
+with its shard and byte offset, so any frame can be read back at random
+without extracting the shards. Since the shards are plain tar files they can
+still be unpacked with standard tools.
+"""
+
+import io
+import os
+import sys
+import tarfile
+import time
+
+sys.path.append("..")
+import python_pfm
+
+from PIL import Image as PImage
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from .flow import decode_png16
+
+
+INDEX_FILENAME = 'index.txt'
+
+# Archive prefix of an episode, episode-level keys start with it.
+EPISODE_FORMAT = 'episode_{:0>4d}'
+
+# Archive key of a sensor measurement, without extension.
+KEY_FORMAT = EPISODE_FORMAT + '/{:s}/{:0>6d}'
+
+
+def _decode(key, payload):
+    """Decode the payload of an archive member according to its extension."""
+    extension = os.path.splitext(key)[1].lower()
+    if extension == '.png':
+        # Bit depth and color type in the IHDR chunk, PIL truncates 16-bit
+        # RGB images (the flow maps) to 8 bits.
+        if payload[24:26] == b'\x10\x02':
+            return decode_png16(payload)
+        return numpy.array(PImage.open(io.BytesIO(payload)))
+    elif extension == '.pfm':
+        return python_pfm.readPFM(io.BytesIO(payload))[0]
+    elif extension == '.npy':
+        return numpy.load(io.BytesIO(payload))
+    elif extension == '.txt':
+        # Labels and poses, parsed by their readers.
+        return payload
+    raise ValueError('archive: cannot decode %r' % key)
+
+
+class ShardWriter(object):
+    """
+    Append-only writer of tar shards. A new shard is started when the current
+    one grows beyond max_shard_size bytes. Members are added to the index on
+    flush, once their data has been written to the shard.
+    """
+
+    def __init__(self, folder, max_shard_size=1 << 30, prefix='shard'):
+        self.folder = folder
+        self.max_shard_size = max_shard_size
+        self.prefix = prefix
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # Never touch existing shards, keep appending new ones.
+        self._shard_id = len([f for f in os.listdir(folder)
+                              if f.startswith(prefix + '-') and f.endswith('.tar')])
+        self._shard_name = None
+        self._tar = None
+        self._pending = []
+        self._index = open(os.path.join(folder, INDEX_FILENAME), 'a')
+
+    def add(self, key, payload):
+        """Append the bytes payload to the archive under the given key."""
+        if self._tar is not None and self._tar.offset >= self.max_shard_size:
+            self._close_shard()
+        if self._tar is None:
+            self._open_shard()
+        info = tarfile.TarInfo(key)
+        info.size = len(payload)
+        info.mtime = time.time()
+        header = info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+        offset = self._tar.offset + len(header)
+        self._tar.addfile(info, io.BytesIO(payload))
+        self._pending.append((key, self._shard_name, offset, len(payload)))
+
+    def flush(self):
+        """Flush the current shard and record the added members in the index."""
+        if self._tar is not None:
+            self._tar.fileobj.flush()
+        if self._pending:
+            self._index.write(''.join('%s\t%s\t%d\t%d\n' % entry for entry in self._pending))
+            self._index.flush()
+            self._pending = []
+
+    def discard(self):
+        """
+        Drop the members added since the last flush, their data stays in the
+        shard but they are never indexed.
+        """
+        self._pending = []
+
+    def close(self):
+        """Flush and close the archive."""
+        self._close_shard()
+        self._index.close()
+
+    def _open_shard(self):
+        self._shard_name = '%s-%06d.tar' % (self.prefix, self._shard_id)
+        self._tar = tarfile.open(os.path.join(self.folder, self._shard_name), 'w')
+        self._shard_id += 1
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self.flush()
+            self._tar.close()
+            self._tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader(object):
+    """
+    Random access reader of the archives written by ShardWriter. Reads members
+    directly at their recorded offsets, later entries of the same key override
+    earlier ones.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._entries = {}
+        self._keys = {}
+        self._shards = {}
+        with open(os.path.join(folder, INDEX_FILENAME), 'r') as index:
+            for line in index:
+                key, shard, offset, size = line.rstrip('\n').split('\t')
+                self._entries[key] = (shard, int(offset), int(size))
+                self._keys[os.path.splitext(key)[0]] = key
+
+    def keys(self):
+        """Return the keys of all the members in the archive."""
+        return sorted(self._entries)
+
+    def read_bytes(self, key):
+        """Return the raw payload stored under key (with extension)."""
+        shard, offset, size = self._entries[key]
+        if shard not in self._shards:
+            self._shards[shard] = open(os.path.join(self.folder, shard), 'rb')
+        shard_file = self._shards[shard]
+        shard_file.seek(offset)
+        return shard_file.read(size)
+
+    def read(self, episode, name, frame):
+        """
+        Return the data of sensor name at the given episode and frame as a
+        numpy array, or as bytes for text members (labels).
+        """
+        key = self._keys[KEY_FORMAT.format(episode, name, frame)]
+        return _decode(key, self.read_bytes(key))
+
+    def close(self):
+        for shard_file in self._shards.values():
+            shard_file.close()
+        self._shards = {}
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,95 @@
+"""
+Bird's-eye view rasterization.
+
+BevRasterizer bins a point-cloud, in the frame of the player vehicle (x
+forward, y right, z up), into a grid of cells seen from above: row i and
+column j hold the points of x in [x_min + i * resolution, ...) and y in
+[y_min + j * resolution, ...). Every cell gets its occupancy, the height of
+its highest point and its number of points.
+"""
+
+import io
+import math
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from . import sensor
+
+
+Bev = namedtuple('Bev', 'occupancy height density')
+
+
+class BevRasterizer(object):
+    """
+    Rasterizes points within x_range, y_range and z_range (in meters) into
+    cells of resolution meters. Densities are normalized as
+    min(1, log(1 + count) / log(max_density)) when encoded.
+    """
+
+    def __init__(self, x_range=(0.0, 70.4), y_range=(-40.0, 40.0), z_range=(-1.0, 3.0),
+                 resolution=0.1, max_density=64):
+        self.x_range = x_range
+        self.y_range = y_range
+        self.z_range = z_range
+        self.resolution = resolution
+        self.max_density = max_density
+        self.shape = (int(round((x_range[1] - x_range[0]) / resolution)),
+                      int(round((y_range[1] - y_range[0]) / resolution)))
+
+    def rasterize(self, point_cloud, transform=None):
+        """
+        Rasterize a PointCloud or a LidarMeasurement, transform (a
+        transform.Transform, e.g. the sensor transform) bringing its points to
+        the vehicle frame if given. Returns a Bev of (rows, columns) arrays:
+        the bool occupancy, the float32 height of the highest point (z_min
+        for empty cells) and the uint32 number of points.
+        """
+        if isinstance(point_cloud, sensor.LidarMeasurement):
+            point_cloud = point_cloud.point_cloud
+        points = point_cloud.array
+        if transform is not None:
+            points = transform.transform_points(points)
+        rows, columns = self.shape
+        scale = 1.0 / self.resolution
+        row = numpy.floor((points[:, 0] - self.x_range[0]) * scale).astype(numpy.int64)
+        column = numpy.floor((points[:, 1] - self.y_range[0]) * scale).astype(numpy.int64)
+        z = numpy.asarray(points[:, 2], dtype=numpy.float32)
+        inside = (row >= 0) & (row < rows) & (column >= 0) & (column < columns) & \
+            (z >= self.z_range[0]) & (z < self.z_range[1])
+        cell = row[inside] * columns + column[inside]
+        z = z[inside]
+
+        density = numpy.bincount(cell, minlength=rows * columns).astype(numpy.uint32)
+        height = numpy.full(rows * columns, self.z_range[0], dtype=numpy.float32)
+        numpy.maximum.at(height, cell, z)
+        return Bev(
+            (density > 0).reshape(self.shape),
+            height.reshape(self.shape),
+            density.reshape(self.shape))
+
+    def encode(self, bev, dtype='uint8'):
+        """
+        Encode a Bev as a (3, rows, columns) npy tensor of occupancy, height
+        and density, returns the extension and the bytes. With uint8 every
+        channel is quantized to [0, 255], heights over z_range. With float16
+        heights are kept in meters and densities normalized to [0, 1].
+        """
+        density = numpy.log1p(bev.density.astype(numpy.float32))
+        density *= 1.0 / math.log(self.max_density)
+        numpy.minimum(density, 1.0, out=density)
+        if dtype == 'uint8':
+            height = (bev.height - self.z_range[0]) * (255.0 / (self.z_range[1] - self.z_range[0]))
+            tensor = numpy.stack([bev.occupancy * 255.0, height, density * 255.0])
+            tensor = numpy.rint(tensor).astype(numpy.uint8)
+        elif dtype == 'float16':
+            tensor = numpy.stack([bev.occupancy, bev.height, density]).astype(numpy.float16)
+        else:
+            raise ValueError('bev.BevRasterizer: unknown dtype %r' % dtype)
+        buffer = io.BytesIO()
+        numpy.save(buffer, tensor)
+        return '.npy', buffer.getvalue()
@@ -0,0 +1,151 @@
+"""
+Raw capture of sensor data.
+
+During generation the raw BGRA buffers of the cameras are copied, undecoded,
+together with the serialized measurements into a preallocated memory-mapped
+file per episode. The conversion to the final formats is done afterwards,
+offline and in parallel (see convert_raw.py).
+
+Layout of episode_[i].raw, one fixed-size slot per saved frame:
+    [uint32 measurements size][measurements, padded][camera 0 BGRA]...
+The slot layout and the metadata are described in episode_[i].json.
+"""
+
+import json
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from . import sensor
+from .archive import EPISODE_FORMAT
+
+
+class RawCaptureWriter(object):
+    """
+    Writes the raw data of up to frames saved ticks per episode. Only camera
+    images are supported.
+    """
+
+    def __init__(self, folder, frames, measurements_size=1 << 16, metadata=None):
+        self.folder = folder
+        self.frames = frames
+        self.measurements_size = measurements_size
+        self.metadata = metadata or {}
+        self._episode = None
+        self._header = None
+        self._array = None
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def begin_episode(self, episode):
+        """Start (or restart) capturing the given episode."""
+        self.end_episode()
+        self._episode = episode
+
+    def write(self, frame, measurements, sensor_data):
+        """Copy the measurements and images of a saved tick to slot frame."""
+        if self._array is None:
+            self._allocate(sensor_data)
+        if frame >= self.frames:
+            raise ValueError('capture: frame %d out of %d preallocated frames' % (frame, self.frames))
+        serialized = measurements.SerializeToString()
+        if len(serialized) > self.measurements_size:
+            raise ValueError('capture: measurements of %d bytes exceed %d bytes' % (
+                len(serialized), self.measurements_size))
+        slot = self._array[frame]
+        slot[:4] = numpy.frombuffer(struct.pack('<L', len(serialized)), dtype=numpy.uint8)
+        slot[4:4 + len(serialized)] = numpy.frombuffer(serialized, dtype=numpy.uint8)
+        for entry in self._header['sensors']:
+            raw_data = sensor_data[entry['name']].raw_data
+            slot[entry['offset']:entry['offset'] + entry['size']] = numpy.frombuffer(raw_data, dtype=numpy.uint8)
+        self._header['frames'] = max(self._header['frames'], frame + 1)
+
+    def end_episode(self):
+        """Flush the captured episode to disk."""
+        if self._array is not None:
+            self._array.flush()
+            self._write_header()
+        self._array = None
+        self._header = None
+
+    def close(self):
+        self.end_episode()
+
+    def _allocate(self, sensor_data):
+        sensors = []
+        offset = 4 + self.measurements_size
+        for name in sorted(sensor_data):
+            image = sensor_data[name]
+            if not isinstance(image, sensor.Image):
+                raise ValueError('capture: sensor %r is not a camera' % name)
+            size = 4 * image.width * image.height
+            sensors.append(dict(
+                name=name, width=image.width, height=image.height,
+                type=image.type, fov=image.fov, offset=offset, size=size))
+            offset += size
+        self._header = dict(
+            frames=0,
+            slot_size=offset,
+            measurements_size=self.measurements_size,
+            sensors=sensors,
+            metadata=self.metadata)
+        self._write_header()
+        filename = os.path.join(self.folder, EPISODE_FORMAT.format(self._episode) + '.raw')
+        self._array = numpy.memmap(filename, dtype=numpy.uint8, mode='w+', shape=(self.frames, offset))
+
+    def _write_header(self):
+        filename = os.path.join(self.folder, EPISODE_FORMAT.format(self._episode) + '.json')
+        with open(filename, 'w') as header_file:
+            json.dump(self._header, header_file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RawCaptureReader(object):
+    """Reads back the frames of an episode captured by RawCaptureWriter."""
+
+    def __init__(self, folder, episode):
+        prefix = os.path.join(folder, EPISODE_FORMAT.format(episode))
+        with open(prefix + '.json', 'r') as header_file:
+            header = json.load(header_file)
+        self.episode = episode
+        self.frames = header['frames']
+        self.sensors = header['sensors']
+        self.metadata = header['metadata']
+        self._array = numpy.memmap(prefix + '.raw', dtype=numpy.uint8, mode='r').reshape(
+            (-1, header['slot_size']))
+
+    def read(self, frame):
+        """
+        Return a pair containing the serialized measurements and a dict of the
+        sensor.Image of frame, the images share memory with the capture file.
+        """
+        if frame >= self.frames:
+            raise IndexError('capture: frame %d out of %d captured frames' % (frame, self.frames))
+        slot = self._array[frame]
+        size = struct.unpack('<L', slot[:4].tobytes())[0]
+        measurements = slot[4:4 + size].tobytes()
+        images = {}
+        for entry in self.sensors:
+            raw_data = memoryview(slot[entry['offset']:entry['offset'] + entry['size']])
+            images[entry['name']] = sensor.Image(
+                frame, entry['width'], entry['height'], entry['type'], entry['fov'], raw_data)
+        return measurements, images
+
+    def __len__(self):
+        return self.frames
+
+
+def list_episodes(folder):
+    """Return the indices of the episodes captured in folder."""
+    prefix, suffix = EPISODE_FORMAT.split('{')[0], '.json'
+    return sorted(int(f[len(prefix):-len(suffix)]) for f in os.listdir(folder)
+                  if f.startswith(prefix) and f.endswith(suffix))
@@ -0,0 +1,273 @@
+"""
+Optical flow ground truth.
+
+The flow of the static scene between two frames follows from the depth map of
+the first frame and the relative pose of the camera: every pixel is
+back-projected along its cached ray (see geometry.ray_grid), moved to the
+second camera and projected again. Pixels on moving agents do not follow the
+ego-motion, the generators mark them invalid when the agents of the frame
+are given.
+
+Flow is written in KITTI's format, a 16-bit RGB PNG holding u * 64 + 2^15,
+v * 64 + 2^15 and the valid flag. The disparity change of SceneFlow, the
+disparity of every pixel in the next frame minus its disparity, is written as
+PFM like the disparity maps, NaN marking the invalid pixels.
+"""
+
+import io
+import struct
+import sys
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+sys.path.append("..")
+import python_pfm
+
+from . import agents as carla_agents
+from . import geometry
+from .labels import LabelGenerator
+from .sensor import FAR_DEPTH
+from .transform import protobuf_transform_arrays, transform_matrices
+
+# Largest flow KITTI's encoding can hold, in pixels.
+_MAX_FLOW = 511.0
+
+
+def ego_flow(depth, relative, intrinsics, max_depth=FAR_DEPTH, near=0.1):
+    """
+    Return the (height, width, 2) float32 flow of a depth map (z in meters)
+    and the (height, width) valid mask, relative being the 4x4 matrix bringing
+    camera coordinates of the first frame to the second. Pixels at or beyond
+    max_depth and pixels moving behind the second camera are invalid.
+    """
+    rays_x, rays_y = geometry.ray_grid(intrinsics)
+    rotation = numpy.asarray(relative[:3, :3], dtype=numpy.float32)
+    translation = numpy.asarray(relative[:3, 3], dtype=numpy.float32)
+    # The back-projected point is depth * (ray_x, ray_y, 1), so the moved
+    # point is depth * (rotation . ray) + translation, one axis at a time.
+    moved = []
+    for axis in range(3):
+        coordinate = rays_x * rotation[axis, 0]
+        coordinate += rays_y * rotation[axis, 1]
+        coordinate += rotation[axis, 2]
+        coordinate *= depth
+        coordinate += translation[axis]
+        moved.append(coordinate)
+    x, y, z = moved
+
+    valid = (depth < max_depth) & (z > near)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        inverse_z = 1.0 / z
+    flow = numpy.empty(depth.shape + (2,), dtype=numpy.float32)
+    # u' - u = fu * (x' / z' - x / z), same for v.
+    with numpy.errstate(invalid='ignore'):
+        numpy.multiply(x, inverse_z, out=flow[:, :, 0])
+        numpy.multiply(y, inverse_z, out=flow[:, :, 1])
+    flow[:, :, 0] -= rays_x
+    flow[:, :, 0] *= intrinsics.fu
+    flow[:, :, 1] -= rays_y
+    flow[:, :, 1] *= intrinsics.fv
+    valid &= numpy.isfinite(flow).all(axis=2)
+    flow[~valid] = 0.0
+    return flow, valid
+
+
+def encode_png16(array, compress_level=1):
+    """
+    Encode a (height, width, 3) uint16 array as a 16-bit RGB PNG, which PIL
+    cannot write, returns the bytes. Higher compression levels barely shrink
+    flow maps and cost several times the encoding time.
+    """
+    height, width, _ = array.shape
+    rows = numpy.zeros((height, 1 + width * 6), dtype=numpy.uint8)
+    # Filter type 0 on every row, big-endian samples.
+    rows[:, 1:] = numpy.ascontiguousarray(array, dtype='>u2').view(numpy.uint8).reshape((height, -1))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 16, 2, 0, 0, 0)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', header),
+        chunk(b'IDAT', zlib.compress(rows.tobytes(), compress_level)),
+        chunk(b'IEND', b'')])
+
+
+def encode_kitti_flow(flow, valid):
+    """Encode flow in KITTI's 16-bit PNG format, returns the extension and the bytes."""
+    valid = valid & (numpy.abs(flow) <= _MAX_FLOW).all(axis=2)
+    array = numpy.zeros(flow.shape[:2] + (3,), dtype=numpy.uint16)
+    array[:, :, :2] = numpy.rint(flow * 64.0 + 32768.0)
+    array[:, :, 2] = valid
+    array[~valid] = 0
+    return '.png', encode_png16(array)
+
+
+def decode_png16(payload):
+    """Decode the bytes of an unfiltered 16-bit RGB PNG, see encode_png16."""
+    offset, chunks = 8, {}
+    while offset < len(payload):
+        length, kind = struct.unpack('>I4s', payload[offset:offset + 8])
+        chunks.setdefault(kind, []).append(payload[offset + 8:offset + 8 + length])
+        offset += 12 + length
+    width, height, depth, color = struct.unpack('>IIBB', chunks[b'IHDR'][0][:10])
+    if depth != 16 or color != 2:
+        raise ValueError('flow: not a 16-bit RGB PNG')
+    rows = numpy.frombuffer(zlib.decompress(b''.join(chunks[b'IDAT'])), dtype=numpy.uint8)
+    rows = rows.reshape((height, 1 + width * 6))
+    if rows[:, 0].any():
+        raise ValueError('flow: filtered PNG rows are not supported')
+    return numpy.ascontiguousarray(rows[:, 1:]).view('>u2').reshape((height, width, 3)).astype(numpy.uint16)
+
+
+def decode_kitti_flow(payload):
+    """Decode a KITTI flow PNG written by encode_kitti_flow, returns the flow and the valid mask."""
+    array = decode_png16(payload)
+    flow = (array[:, :, :2].astype(numpy.float32) - 32768.0) / 64.0
+    return flow, array[:, :, 2] > 0
+
+
+def disparity_change(depth, relative, intrinsics, baseline, max_depth=FAR_DEPTH, near=0.1, rows=64):
+    """
+    Return the (height, width) float32 disparity change of a depth map (z in
+    meters), fu * baseline / z' - fu * baseline / z where z' is the depth of
+    the pixel point in the next camera, relative bringing camera coordinates
+    to the next frame. Only rows rows are warped at once to bound the memory,
+    pixels at or beyond max_depth or moving behind the camera get NaN.
+    """
+    rays_x, rays_y = geometry.ray_grid(intrinsics)
+    # Only the depth of the moved point matters.
+    row = numpy.asarray(relative[2], dtype=numpy.float32)
+    focal_baseline = numpy.float32(intrinsics.fu * baseline)
+    change = numpy.empty(depth.shape, dtype=numpy.float32)
+    for start in range(0, depth.shape[0], rows):
+        window = slice(start, start + rows)
+        chunk_depth = depth[window]
+        z = rays_x[window] * row[0]
+        z += rays_y[window] * row[1]
+        z += row[2]
+        z *= chunk_depth
+        z += row[3]
+        invalid = (chunk_depth >= max_depth) | (z <= near)
+        z[invalid] = 1.0
+        out = change[window]
+        numpy.divide(focal_baseline, z, out=out)
+        out -= focal_baseline / numpy.where(invalid, 1.0, chunk_depth)
+        out[invalid] = numpy.nan
+    return change
+
+
+def encode_pfm(array):
+    """Encode a float32 map as PFM, like the disparity maps, returns the extension and the bytes."""
+    buffer = io.BytesIO()
+    python_pfm.writePFM(buffer, array)
+    return '.pfm', buffer.getvalue()
+
+
+def _camera_pose(player_transform, camera_to_car):
+    location, rotation = protobuf_transform_arrays([player_transform])
+    return numpy.dot(transform_matrices(location, rotation)[0], camera_to_car)
+
+
+class FlowGenerator(object):
+    """
+    Computes the flow between consecutive frames of camera, a sensor.Camera
+    description. Feed every saved frame to update, it returns the flow from
+    the previous frame to this one.
+
+    Pixels inside the projected box of an agent moving faster than min_speed
+    (in m/s), and not farther than the box, are marked invalid.
+    """
+
+    def __init__(self, camera, intrinsics=None, min_speed=0.1, max_depth=FAR_DEPTH):
+        self.intrinsics = intrinsics or geometry.intrinsics_from_camera(camera)
+        self.min_speed = min_speed
+        self.max_depth = max_depth
+        self._camera_to_car = numpy.linalg.inv(geometry.car_to_camera(camera))
+        self._labels = LabelGenerator(camera, self.intrinsics, min_visibility=0.0)
+        self._previous = None
+
+    def update(self, depth, player_transform, agents=None):
+        """
+        Add a frame given its (height, width) depth map in meters, the player
+        protobuf transform and the frame agents (see agents.extract_agents),
+        returns the flow and valid mask of the previous frame, None for the
+        first frame.
+        """
+        pair = self._advance(depth, player_transform, agents)
+        if pair is None:
+            return None
+        previous_depth, relative, moving = pair
+        flow, valid = ego_flow(previous_depth, relative, self.intrinsics, self.max_depth)
+        if moving is not None:
+            valid &= ~moving
+        return flow, valid
+
+    def _advance(self, depth, player_transform, agents):
+        # Store the frame, return the previous depth, the relative pose from
+        # the previous camera to this one and the previous moving mask.
+        pose = _camera_pose(player_transform, self._camera_to_car)
+        previous, self._previous = self._previous, (depth, pose, player_transform, agents)
+        if previous is None:
+            return None
+        previous_depth, previous_pose, previous_transform, previous_agents = previous
+        relative = numpy.dot(numpy.linalg.inv(pose), previous_pose)
+        moving = None
+        if previous_agents is not None:
+            moving = self.moving_mask(previous_depth, previous_transform, previous_agents)
+        return previous_depth, relative, moving
+
+    def moving_mask(self, depth, player_transform, agents):
+        """Return the (height, width) mask of the pixels on moving agents."""
+        moving = agents[(agents['forward_speed'] > self.min_speed) & (
+            (agents['type'] == carla_agents.VEHICLE) | (agents['type'] == carla_agents.PEDESTRIAN))]
+        mask = numpy.zeros(depth.shape, dtype=bool)
+        labels = self._labels.generate(moving, player_transform)
+        # Farthest depth of every box, its center plus its half diagonal.
+        far = labels['location'][:, 2] + 0.5 * numpy.sqrt((labels['dimensions'] ** 2).sum(axis=1))
+        for (left, top, right, bottom), box_far in zip(labels['bbox'].astype(numpy.intp), far):
+            window = (slice(top, bottom + 1), slice(left, right + 1))
+            mask[window] |= depth[window] <= box_far
+        return mask
+
+    def reset(self):
+        """Forget the previous frame, at the start of an episode."""
+        self._previous = None
+
+
+class DisparityChangeGenerator(FlowGenerator):
+    """
+    Computes the disparity change between consecutive frames of camera, a
+    sensor.Camera description of one camera of a stereo rig of the given
+    baseline (in meters). Feed every saved frame to update, it returns the
+    disparity change from the previous frame to this one. Invalid pixels and
+    pixels on moving agents, see FlowGenerator, are NaN.
+    """
+
+    def __init__(self, camera, baseline, intrinsics=None, min_speed=0.1, max_depth=FAR_DEPTH, rows=64):
+        super(DisparityChangeGenerator, self).__init__(camera, intrinsics, min_speed, max_depth)
+        self.baseline = baseline
+        self.rows = rows
+
+    def update(self, depth, player_transform, agents=None):
+        """
+        Add a frame given its (height, width) depth map in meters, the player
+        protobuf transform and the frame agents (see agents.extract_agents),
+        returns the disparity change of the previous frame, None for the
+        first frame.
+        """
+        pair = self._advance(depth, player_transform, agents)
+        if pair is None:
+            return None
+        previous_depth, relative, moving = pair
+        change = disparity_change(
+            previous_depth, relative, self.intrinsics, self.baseline, self.max_depth, rows=self.rows)
+        if moving is not None:
+            change[moving] = numpy.nan
+        return change
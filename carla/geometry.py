@@ -0,0 +1,118 @@
+"""
+Camera geometry helpers.
+
+Camera coordinates follow the usual computer vision convention, x right, y
+down and z forward, while sensors and the player vehicle use the Unreal
+convention, x forward, y right and z up. Pixel (u, v) of a camera sees the
+ray (x / z, y / z) = ((u - cu) / fu, (v - cv) / fv).
+"""
+
+import math
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+
+Intrinsics = namedtuple('Intrinsics', 'fu fv cu cv width height')
+
+
+# Unreal (x forward, y right, z up) to camera (x right, y down, z forward).
+UNREAL_TO_CAMERA = numpy.array([
+    [0.0, 1.0, 0.0, 0.0],
+    [0.0, 0.0, -1.0, 0.0],
+    [1.0, 0.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0]])
+
+CAMERA_TO_UNREAL = UNREAL_TO_CAMERA.T.copy()
+
+
+# Ray grids by intrinsics.
+_RAY_GRIDS = {}
+
+
+def intrinsics_from_fov(width, height, fov):
+    """Intrinsics of a CARLA camera, square pixels and centered principal point."""
+    focal = width / (2.0 * math.tan(fov * math.pi / 360.0))
+    return Intrinsics(focal, focal, width / 2.0, height / 2.0, int(width), int(height))
+
+
+def intrinsics_from_camera(camera):
+    """Intrinsics of a sensor.Camera description."""
+    return intrinsics_from_fov(camera.ImageSizeX, camera.ImageSizeY, camera.FOV)
+
+
+def intrinsics_from_image(image):
+    """Intrinsics of the camera that produced a sensor.Image."""
+    return intrinsics_from_fov(image.width, image.height, image.fov)
+
+
+def car_to_camera(camera):
+    """
+    Return the 4x4 matrix bringing points from the frame the camera is
+    attached to (the player vehicle) to camera coordinates.
+    """
+    to_car = numpy.asarray(camera.get_transform().matrix, dtype=numpy.float64)
+    return numpy.dot(UNREAL_TO_CAMERA, numpy.linalg.inv(to_car))
+
+
+def ray_grid(intrinsics):
+    """
+    Return the (height, width) float32 arrays x / z and y / z of the ray of
+    every pixel, cached by intrinsics. The arrays are read-only.
+    """
+    if intrinsics not in _RAY_GRIDS:
+        rays_x = (numpy.arange(intrinsics.width, dtype=numpy.float32) - intrinsics.cu) / intrinsics.fu
+        rays_y = (numpy.arange(intrinsics.height, dtype=numpy.float32) - intrinsics.cv) / intrinsics.fv
+        rays_x, rays_y = numpy.meshgrid(rays_x, rays_y)
+        rays_x.flags.writeable = False
+        rays_y.flags.writeable = False
+        _RAY_GRIDS[intrinsics] = (rays_x, rays_y)
+    return _RAY_GRIDS[intrinsics]
+
+
+def back_project(depth, intrinsics):
+    """
+    Return the (height, width, 3) float32 camera coordinates of every pixel of
+    a depth map (z in meters).
+    """
+    rays_x, rays_y = ray_grid(intrinsics)
+    points = numpy.empty(depth.shape + (3,), dtype=numpy.float32)
+    numpy.multiply(rays_x, depth, out=points[:, :, 0])
+    numpy.multiply(rays_y, depth, out=points[:, :, 1])
+    points[:, :, 2] = depth
+    return points
+
+
+def project(points, intrinsics):
+    """
+    Project (N, 3) camera coordinates to pixels, returns the float u, v and z
+    arrays. Points behind the camera get non finite coordinates.
+    """
+    z = points[:, 2]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        inverse_z = numpy.where(z > 0.0, 1.0 / z, numpy.nan)
+    u = points[:, 0] * inverse_z * intrinsics.fu + intrinsics.cu
+    v = points[:, 1] * inverse_z * intrinsics.fv + intrinsics.cv
+    return u, v, z
+
+
+def z_buffer(pixel, z, size):
+    """
+    Keep the nearest of the points falling into the same pixel. pixel holds
+    linear pixel indices in [0, size), returns the (size,) z image, 0 meaning
+    empty, and the index of the kept point of every pixel, -1 if empty.
+    """
+    order = numpy.lexsort((z, pixel))
+    sorted_pixel = pixel[order]
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = sorted_pixel[1:] != sorted_pixel[:-1]
+    order = order[first]
+    image = numpy.zeros(size, dtype=numpy.float32)
+    image[pixel[order]] = z[order]
+    index = numpy.full(size, -1, dtype=numpy.int64)
+    index[pixel[order]] = order
+    return image, index
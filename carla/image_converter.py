@@ -22,9 +22,14 @@ except ImportError:
     raise RuntimeError('cannot import numpy, make sure numpy package is installed')
 
 
+from . import geometry
 from . import sensor
 
 
+# Number of classes of the semantic segmentation, see labels_to_cityscapes_palette.
+SEGMENTATION_CLASSES = 13
+
+
 def to_bgra_array(image):
     """Convert a CARLA raw image to a BGRA numpy array."""
     if not isinstance(image, sensor.Image):
@@ -51,6 +56,14 @@ def labels_to_array(image):
     return to_bgra_array(image)[:, :, 2]
 
 
+def class_histogram(image):
+    """
+    Return the number of pixels of every class of an image containing CARLA
+    semantic segmentation labels, an array of SEGMENTATION_CLASSES counts.
+    """
+    return numpy.bincount(labels_to_array(image).ravel(), minlength=SEGMENTATION_CLASSES)
+
+
 def labels_to_cityscapes_palette(image):
     """
     Convert an image containing CARLA semantic segmentation labels to
@@ -160,3 +173,57 @@ def depth_to_local_point_cloud(image, color=None, max_depth=0.9):
             color_array=color)
     # [[X1,Y1,Z1],[X2,Y2,Z2], ... [Xn,Yn,Zn]]
     return sensor.PointCloud(image.frame_number, numpy.transpose(p3d))
+
+
+def depth_to_colored_point_cloud(depth_image, rgb_image, max_depth=0.9,
+                                 right_depth_image=None, right_rgb_image=None,
+                                 baseline=0.54):
+    """
+    Convert a CARLA encoded depth-map and the matching RGB image to a colored
+    point-cloud in one pass, with the same coordinates (relative to the
+    camera) as depth_to_local_point_cloud. Decoding, masking and coloring
+    share a single mask.
+    If the depth-map and RGB image of the right camera of a stereo pair are
+    given, its points are merged into the point-cloud of the left camera
+    using the baseline (in meters) of the pair.
+    "max_depth" is used to omit the points that are far enough.
+    """
+    arrays, color_arrays = _depth_to_colored_points(depth_image, rgb_image, max_depth, 0.0)
+    if right_depth_image is not None:
+        right_arrays, right_color_arrays = _depth_to_colored_points(
+            right_depth_image, right_rgb_image, max_depth, -baseline)
+        arrays = numpy.concatenate((arrays, right_arrays))
+        color_arrays = numpy.concatenate((color_arrays, right_color_arrays))
+    return sensor.PointCloud(depth_image.frame_number, arrays, color_array=color_arrays)
+
+
+def _depth_to_colored_points(depth_image, rgb_image, max_depth, offset_x):
+    far = 1000.0  # max depth in meters.
+    if (depth_image.width, depth_image.height) != (rgb_image.width, rgb_image.height):
+        raise ValueError('depth and RGB images must have the same size')
+
+    # Decode R + G * 256 + B * 256 * 256 straight from the BGRA words.
+    words = numpy.frombuffer(depth_image.raw_data, dtype=numpy.dtype('<u4'))
+    encoded = (words & 0xff) << 16
+    encoded |= words & 0xff00
+    encoded |= (words >> 16) & 0xff
+    mask = encoded <= int(max_depth * 16777215.0)
+    depth = encoded[mask] * numpy.float32(far / 16777215.0)
+
+    # Same pixel coordinates as depth_to_local_point_cloud, which flips both
+    # image axes.
+    width, height = depth_image.width, depth_image.height
+    focal = width / (2.0 * math.tan(depth_image.fov * math.pi / 360.0))
+    rays_x, rays_y = geometry.ray_grid(geometry.Intrinsics(
+        focal, focal, width - 1 - width / 2.0, height - 1 - height / 2.0, width, height))
+    points = numpy.empty((len(depth), 3), dtype=numpy.float32)
+    numpy.multiply(rays_x.reshape(-1)[mask], depth, out=points[:, 0])
+    numpy.negative(points[:, 0], out=points[:, 0])
+    points[:, 0] += offset_x
+    numpy.multiply(rays_y.reshape(-1)[mask], depth, out=points[:, 1])
+    numpy.negative(points[:, 1], out=points[:, 1])
+    points[:, 2] = depth
+
+    # BGRA to RGB.
+    colors = to_bgra_array(rgb_image).reshape((-1, 4))[mask][:, 2::-1]
+    return points, numpy.ascontiguousarray(colors)
@@ -0,0 +1,163 @@
+"""
+KITTI-style object labels.
+
+LabelGenerator batches the bounding boxes of all the vehicles and pedestrians
+of a tick into one (N, 8, 3) corner array, brings them to camera coordinates,
+projects them, culls the boxes outside the frustum, clipping the ones crossing
+the near plane, and tests the remaining ones for occlusion against the depth
+map of the camera, all with numpy.
+encode_labels writes the result in the format of KITTI's label_2 files.
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from . import agents as carla_agents
+from . import geometry
+from .transform import apply_transforms, protobuf_transform_arrays, transform_matrices
+
+
+LABEL_DTYPE = numpy.dtype([
+    ('id', '<u4'),
+    ('type', 'u1'),
+    ('truncated', '<f4'),
+    ('occluded', 'u1'),
+    ('alpha', '<f4'),
+    ('bbox', '<f4', (4,)),
+    ('dimensions', '<f4', (3,)),
+    ('location', '<f4', (3,)),
+    ('rotation_y', '<f4')])
+
+KITTI_TYPES = {carla_agents.VEHICLE: 'Car', carla_agents.PEDESTRIAN: 'Pedestrian'}
+
+# Corners of a box of half-sizes 1, in the box frame.
+_CORNERS = numpy.array([
+    [x, y, z] for x in (1.0, -1.0) for y in (1.0, -1.0) for z in (1.0, -1.0)])
+
+# Corner indices of the 12 edges of a box, the corners differing by one axis.
+_EDGES = numpy.array([
+    (i, j) for i in range(8) for j in range(i + 1, 8)
+    if numpy.count_nonzero(_CORNERS[i] != _CORNERS[j]) == 1])
+
+
+class LabelGenerator(object):
+    """
+    Generates the labels of the agents visible from camera, a sensor.Camera
+    description. The intrinsics default to the ones of the camera.
+
+    Boxes are tested for occlusion on a samples x samples grid over their 2D
+    box, a sample is visible if the depth map is not closer than the nearest
+    corner of the box minus tolerance meters. Boxes with less than
+    min_visibility of their samples visible are dropped.
+    """
+
+    def __init__(self, camera, intrinsics=None, max_distance=100.0, min_visibility=0.1,
+                 samples=8, tolerance=0.5, near=0.1):
+        self.intrinsics = intrinsics or geometry.intrinsics_from_camera(camera)
+        self.max_distance = max_distance
+        self.min_visibility = min_visibility
+        self.samples = samples
+        self.tolerance = tolerance
+        self.near = near
+        self._car_to_camera = geometry.car_to_camera(camera)
+
+    def generate(self, agents, player_transform, depth=None):
+        """
+        Return the labels, an array of LABEL_DTYPE, of an array of agents
+        (see agents.extract_agents) given the player protobuf transform and
+        the (height, width) depth map of the camera in meters, if any.
+        """
+        is_box = (agents['type'] == carla_agents.VEHICLE) | (agents['type'] == carla_agents.PEDESTRIAN)
+        boxes = agents[is_box]
+        if len(boxes) == 0:
+            return numpy.zeros(0, dtype=LABEL_DTYPE)
+
+        # Box to camera transforms of all the boxes at once.
+        location, rotation = protobuf_transform_arrays([player_transform])
+        world_to_camera = numpy.dot(
+            self._car_to_camera, numpy.linalg.inv(transform_matrices(location, rotation)[0]))
+        box_to_world = numpy.matmul(
+            transform_matrices(boxes['location'], boxes['rotation']),
+            transform_matrices(boxes['box_location'], boxes['box_rotation']))
+        box_to_camera = numpy.matmul(world_to_camera, box_to_world)
+        extent = boxes['extent'].astype(numpy.float64)
+        corners = apply_transforms(box_to_camera, _CORNERS * extent[:, numpy.newaxis, :])
+
+        # Frustum culling, any corner in front of the camera and in range.
+        z = corners[:, :, 2]
+        keep = (z.max(axis=1) > self.near) & (z.min(axis=1) < self.max_distance)
+        corners, z, boxes, box_to_camera, extent = \
+            corners[keep], z[keep], boxes[keep], box_to_camera[keep], extent[keep]
+        # Clip the boxes crossing the near plane, the points projected are
+        # the corners in front and the crossings of the edges with the plane.
+        first, second = corners[:, _EDGES[:, 0], :], corners[:, _EDGES[:, 1], :]
+        z_first, z_second = first[:, :, 2], second[:, :, 2]
+        crossing = (z_first > self.near) != (z_second > self.near)
+        t = (self.near - z_first) / numpy.where(crossing, z_second - z_first, 1.0)
+        points = numpy.concatenate([corners, first + t[:, :, numpy.newaxis] * (second - first)], axis=1)
+        in_front = numpy.concatenate([z > self.near, crossing], axis=1)
+        points_z = numpy.where(in_front, points[:, :, 2], 1.0)
+        u = points[:, :, 0] / points_z * self.intrinsics.fu + self.intrinsics.cu
+        v = points[:, :, 1] / points_z * self.intrinsics.fv + self.intrinsics.cv
+        u_min, v_min = numpy.where(in_front, u, numpy.inf), numpy.where(in_front, v, numpy.inf)
+        u_max, v_max = numpy.where(in_front, u, -numpy.inf), numpy.where(in_front, v, -numpy.inf)
+        # Depth of the nearest visible point, for the occlusion test.
+        nearest = numpy.maximum(z.min(axis=1), self.near)
+        full = numpy.stack([u_min.min(axis=1), v_min.min(axis=1), u_max.max(axis=1), v_max.max(axis=1)], axis=1)
+        bbox = full.copy()
+        numpy.clip(bbox[:, 0::2], 0.0, self.intrinsics.width - 1.0, out=bbox[:, 0::2])
+        numpy.clip(bbox[:, 1::2], 0.0, self.intrinsics.height - 1.0, out=bbox[:, 1::2])
+        area = (bbox[:, 2] - bbox[:, 0]) * (bbox[:, 3] - bbox[:, 1])
+        full_area = (full[:, 2] - full[:, 0]) * (full[:, 3] - full[:, 1])
+        keep = area > 0.0
+        truncated = numpy.where(keep, 1.0 - area / numpy.maximum(full_area, 1e-6), 1.0)
+
+        # Occlusion test on a grid of samples over every 2D box.
+        visibility = numpy.ones(len(bbox))
+        if depth is not None and len(bbox):
+            steps = (numpy.arange(self.samples) + 0.5) / self.samples
+            sample_u = bbox[:, 0:1] + (bbox[:, 2:3] - bbox[:, 0:1]) * steps
+            sample_v = bbox[:, 1:2] + (bbox[:, 3:4] - bbox[:, 1:2]) * steps
+            sample_u = sample_u.astype(numpy.intp)[:, numpy.newaxis, :]
+            sample_v = sample_v.astype(numpy.intp)[:, :, numpy.newaxis]
+            sampled = depth[sample_v, sample_u].reshape((len(bbox), -1))
+            visible = sampled >= (nearest - self.tolerance)[:, numpy.newaxis]
+            visibility = visible.mean(axis=1)
+        keep &= visibility >= self.min_visibility
+
+        labels = numpy.zeros(numpy.count_nonzero(keep), dtype=LABEL_DTYPE)
+        box_to_camera, extent, visibility = box_to_camera[keep], extent[keep], visibility[keep]
+        labels['id'] = boxes['id'][keep]
+        labels['type'] = boxes['type'][keep]
+        labels['truncated'] = truncated[keep]
+        labels['occluded'] = numpy.where(visibility >= 0.75, 0, numpy.where(visibility >= 0.4, 1, 2))
+        labels['bbox'] = bbox[keep]
+        # Height, width, length.
+        labels['dimensions'] = 2.0 * extent[:, [2, 1, 0]]
+        # Bottom center of the box.
+        bottom = numpy.zeros((len(extent), 1, 3))
+        bottom[:, 0, 2] = -extent[:, 2]
+        location = apply_transforms(box_to_camera, bottom)[:, 0, :]
+        labels['location'] = location
+        # Rotation of the box forward axis around the camera y axis.
+        forward = box_to_camera[:, :3, 0]
+        rotation_y = numpy.arctan2(-forward[:, 2], forward[:, 0])
+        labels['rotation_y'] = rotation_y
+        alpha = rotation_y - numpy.arctan2(location[:, 0], location[:, 2])
+        labels['alpha'] = (alpha + math.pi) % (2.0 * math.pi) - math.pi
+        return labels
+
+
+def encode_labels(labels):
+    """Encode an array of LABEL_DTYPE as a KITTI label_2 text file."""
+    lines = []
+    for label in labels:
+        lines.append('%s %.2f %d %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f\n' % (
+            (KITTI_TYPES[int(label['type'])], label['truncated'], label['occluded'], label['alpha']) +
+            tuple(label['bbox']) + tuple(label['dimensions']) + tuple(label['location']) +
+            (label['rotation_y'],)))
+    return '.txt', ''.join(lines).encode('ascii')
@@ -0,0 +1,134 @@
+"""
+Handy conversions for CARLA lidar measurements.
+
+The range image of a lidar is a dense "channels x azimuth bins" grid, row i
+holds the points of channel i (from UpperFovLimit down to LowerFovLimit) and
+the columns split a full rotation starting at azimuth -pi.
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed')
+
+
+from . import geometry
+from . import sensor
+from .transform import apply_transforms
+
+
+# Angle tables by lidar configuration.
+_ANGLE_TABLES = {}
+
+# Lidar to camera transforms by rig.
+_EXTRINSICS = {}
+
+
+def range_image_shape(lidar):
+    """Return the (rows, columns) of the range image of a sensor.Lidar."""
+    columns = int(round(lidar.PointsPerSecond / (lidar.RotationFrequency * lidar.Channels)))
+    return lidar.Channels, max(columns, 1)
+
+
+def angle_table(lidar):
+    """
+    Return the elevation of every row and the azimuth of the center of every
+    column of the range image in radians, cached by lidar configuration.
+    """
+    rows, columns = range_image_shape(lidar)
+    key = (rows, columns, float(lidar.UpperFovLimit), float(lidar.LowerFovLimit))
+    if key not in _ANGLE_TABLES:
+        elevations = numpy.radians(numpy.linspace(
+            lidar.UpperFovLimit, lidar.LowerFovLimit, rows, dtype=numpy.float64))
+        azimuths = -math.pi + (numpy.arange(columns) + 0.5) * (2.0 * math.pi / columns)
+        elevations.flags.writeable = False
+        azimuths.flags.writeable = False
+        _ANGLE_TABLES[key] = (elevations, azimuths)
+    return _ANGLE_TABLES[key]
+
+
+def to_range_image(data, lidar, max_range=None):
+    """
+    Project a LidarMeasurement (or a PointCloud in the lidar frame) to a range
+    image. Returns a (rows, columns) float32 range image, 0 meaning no return,
+    and the matching (rows, columns, 3) float32 image of point coordinates.
+    When several points fall into a pixel the nearest one is kept.
+
+    Rows are taken from the channel of the points of a LidarMeasurement, and
+    from the nearest elevation of the angle table for a PointCloud.
+    """
+    rows, columns = range_image_shape(lidar)
+    elevations, _ = angle_table(lidar)
+    if isinstance(data, sensor.LidarMeasurement):
+        points = numpy.asarray(data.data, dtype=numpy.float32)
+        row = data.channel_ids.astype(numpy.int64)
+    else:
+        points = numpy.asarray(data.array, dtype=numpy.float32)
+        row = None
+
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    planar = numpy.hypot(x, y)
+    ranges = numpy.hypot(planar, z)
+    if row is None:
+        # The table is evenly spaced, round to the nearest row.
+        if rows > 1:
+            step = (elevations[-1] - elevations[0]) / (rows - 1)
+            row = numpy.rint((numpy.arctan2(z, planar) - elevations[0]) / step).astype(numpy.int64)
+        else:
+            row = numpy.zeros(len(points), dtype=numpy.int64)
+    column = numpy.floor((numpy.arctan2(y, x) + math.pi) * (columns / (2.0 * math.pi))).astype(numpy.int64)
+    column %= columns
+
+    keep = (row >= 0) & (row < rows) & (ranges > 0.0)
+    if max_range is not None:
+        keep &= ranges <= max_range
+    points = points[keep]
+    range_image, index = geometry.z_buffer((row * columns + column)[keep], ranges[keep], rows * columns)
+    xyz_image = numpy.zeros((rows * columns, 3), dtype=numpy.float32)
+    hit = index >= 0
+    xyz_image[hit] = points[index[hit]]
+    return range_image.reshape((rows, columns)), xyz_image.reshape((rows, columns, 3))
+
+
+class LidarCameraProjector(object):
+    """
+    Projects lidar points into a camera, producing sparse depth maps aligned
+    with the camera images. lidar and camera are the sensor.Lidar and
+    sensor.Camera descriptions of the rig, the points of the measurements are
+    expected in the lidar frame (x forward, y right, z up). The intrinsics
+    default to the ones of the camera description (see geometry.Intrinsics).
+    """
+
+    def __init__(self, lidar, camera, intrinsics=None):
+        self.intrinsics = intrinsics or geometry.intrinsics_from_camera(camera)
+        key = tuple(getattr(s, attribute) for s in (lidar, camera) for attribute in (
+            'PositionX', 'PositionY', 'PositionZ', 'RotationPitch', 'RotationYaw', 'RotationRoll'))
+        if key not in _EXTRINSICS:
+            _EXTRINSICS[key] = numpy.dot(
+                geometry.car_to_camera(camera),
+                numpy.asarray(lidar.get_transform().matrix, dtype=numpy.float64))
+        # Lidar to camera coordinates.
+        self.extrinsic = _EXTRINSICS[key]
+
+    def project(self, data, max_depth=None):
+        """
+        Project a LidarMeasurement (or a PointCloud in the lidar frame), return
+        the (height, width) float32 depth map, 0 where no point falls, keeping
+        the nearest point per pixel, and the boolean mask of valid pixels.
+        """
+        width, height = self.intrinsics.width, self.intrinsics.height
+        points = data.data if isinstance(data, sensor.LidarMeasurement) else data.array
+        points = apply_transforms(self.extrinsic, numpy.asarray(points, dtype=numpy.float32))
+        u, v, z = geometry.project(points, self.intrinsics)
+        keep = numpy.isfinite(u) & numpy.isfinite(v)
+        if max_depth is not None:
+            keep &= z <= max_depth
+        column = numpy.floor(u[keep]).astype(numpy.int64)
+        row = numpy.floor(v[keep]).astype(numpy.int64)
+        z = z[keep]
+        inside = (column >= 0) & (column < width) & (row >= 0) & (row < height)
+        depth, _ = geometry.z_buffer((row * width + column)[inside], z[inside], width * height)
+        depth = depth.reshape((height, width))
+        return depth, depth > 0.0
@@ -0,0 +1,139 @@
+"""
+Incremental point-cloud maps.
+
+A VoxelMap accumulates point-clouds given in world coordinates (or with the
+pose that brings them there) into a sparse voxel grid. Every voxel keeps the
+running sum of its points, so the exported map holds one point per voxel,
+the centroid, no matter how many frames have been inserted.
+"""
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from . import sensor
+
+
+# Voxel coordinates are stored with 21 bits per axis.
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+_KEY_MASK = (1 << _KEY_BITS) - 1
+
+
+def voxel_keys(array, voxel_size):
+    """
+    Return the int64 key of the voxel of every point of a (N, 3) array, the
+    keys do not depend on the other points.
+    """
+    key = numpy.zeros(len(array), dtype=numpy.int64)
+    for axis in range(3):
+        coordinate = numpy.floor(array[:, axis] * (1.0 / voxel_size)).astype(numpy.int64)
+        coordinate += _KEY_OFFSET
+        numpy.clip(coordinate, 0, _KEY_MASK, out=coordinate)
+        key <<= _KEY_BITS
+        key |= coordinate
+    return key
+
+
+class VoxelMap(object):
+    """
+    Sparse voxel map with bounded memory.
+
+    If max_distance is set, voxels farther than max_distance from the last
+    inserted pose are dropped. If max_voxels is set, the least recently
+    observed voxels are dropped to keep at most max_voxels voxels.
+    """
+
+    def __init__(self, voxel_size=0.1, max_distance=None, max_voxels=None):
+        self.voxel_size = voxel_size
+        self.max_distance = max_distance
+        self.max_voxels = max_voxels
+        self.frames = 0
+        # Sorted voxel keys and their accumulated data.
+        self._keys = numpy.zeros(0, dtype=numpy.int64)
+        self._sums = numpy.zeros((0, 3), dtype=numpy.float64)
+        self._color_sums = None
+        self._counts = numpy.zeros(0, dtype=numpy.int64)
+        self._last_seen = numpy.zeros(0, dtype=numpy.int64)
+
+    def insert(self, point_cloud, transform=None):
+        """
+        Insert a PointCloud, transform (a transform.Transform) brings its
+        points to world coordinates if given.
+        """
+        points = numpy.asarray(point_cloud.array, dtype=numpy.float64)
+        center = numpy.zeros(3)
+        if transform is not None:
+            points = numpy.asarray(transform.transform_points(points), dtype=numpy.float64)
+            center = numpy.asarray(transform.matrix)[:3, 3]
+        colors = point_cloud.color_array if point_cloud.has_colors() else None
+        if self._color_sums is None and colors is not None and len(self._keys) == 0:
+            self._color_sums = numpy.zeros((0, 3), dtype=numpy.float64)
+
+        # Reduce the frame to its voxels first.
+        keys, inverse = numpy.unique(voxel_keys(points, self.voxel_size), return_inverse=True)
+        inverse = inverse.ravel()
+        counts = numpy.bincount(inverse, minlength=len(keys))
+        sums = numpy.stack([numpy.bincount(inverse, points[:, axis], len(keys)) for axis in range(3)], axis=1)
+        color_sums = None
+        if self._color_sums is not None:
+            if colors is None:
+                raise ValueError('mapping.VoxelMap: the map has colors, the point-cloud has not')
+            color_sums = numpy.stack(
+                [numpy.bincount(inverse, colors[:, channel], len(keys)) for channel in range(3)], axis=1)
+
+        # Merge with the map, both key arrays are sorted.
+        position = numpy.searchsorted(self._keys, keys)
+        found = position < len(self._keys)
+        found[found] = self._keys[position[found]] == keys[found]
+        existing = position[found]
+        self._sums[existing] += sums[found]
+        self._counts[existing] += counts[found]
+        self._last_seen[existing] = self.frames
+        if self._color_sums is not None:
+            self._color_sums[existing] += color_sums[found]
+
+        new = ~found
+        position = position[new]
+        self._keys = numpy.insert(self._keys, position, keys[new])
+        self._sums = numpy.insert(self._sums, position, sums[new], axis=0)
+        self._counts = numpy.insert(self._counts, position, counts[new])
+        self._last_seen = numpy.insert(self._last_seen, position, self.frames)
+        if self._color_sums is not None:
+            self._color_sums = numpy.insert(self._color_sums, position, color_sums[new], axis=0)
+
+        self.frames += 1
+        self._evict(center)
+
+    def to_point_cloud(self):
+        """Export the map as a PointCloud with the centroid of every voxel."""
+        counts = self._counts[:, numpy.newaxis]
+        array = (self._sums / counts).astype(numpy.float32)
+        color_array = None
+        if self._color_sums is not None:
+            color_array = numpy.rint(self._color_sums / counts).astype(numpy.uint8)
+        return sensor.PointCloud(self.frames, array, color_array=color_array)
+
+    def _evict(self, center):
+        keep = numpy.ones(len(self._keys), dtype=bool)
+        if self.max_distance is not None:
+            offset = self._sums / self._counts[:, numpy.newaxis] - center
+            keep &= numpy.einsum('ij,ij->i', offset, offset) <= self.max_distance * self.max_distance
+        if self.max_voxels is not None:
+            candidates = numpy.flatnonzero(keep)
+            if len(candidates) > self.max_voxels:
+                # Keep the most recently seen voxels.
+                recent = numpy.argsort(-self._last_seen[candidates], kind='mergesort')[:self.max_voxels]
+                keep[:] = False
+                keep[candidates[recent]] = True
+        if not keep.all():
+            self._keys = self._keys[keep]
+            self._sums = self._sums[keep]
+            self._counts = self._counts[keep]
+            self._last_seen = self._last_seen[keep]
+            if self._color_sums is not None:
+                self._color_sums = self._color_sums[keep]
+
+    def __len__(self):
+        return len(self._keys)
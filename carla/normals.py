@@ -0,0 +1,92 @@
+"""
+Surface normals from depth maps.
+
+Every pixel is back-projected along its cached ray, the normal is the cross
+product of the finite differences of the points along the rows and the
+columns. At depth edges the central difference would mix both surfaces, so
+along each direction the one-sided difference with the smaller depth jump is
+used, and pixels whose neighbours all jump are left invalid.
+"""
+
+import io
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from PIL import Image as PImage
+
+from . import geometry
+from .sensor import FAR_DEPTH
+
+
+def _difference(points, depth, axis, max_jump):
+    # One-sided differences along axis, the one with the smaller depth jump.
+    size = points.shape[axis]
+    step = numpy.diff(points, axis=axis)
+    jump = numpy.abs(numpy.diff(depth, axis=axis))
+    forward = [slice(None)] * 2
+    backward = [slice(None)] * 2
+    forward[axis], backward[axis] = slice(0, size - 1), slice(1, size)
+    forward, backward = tuple(forward), tuple(backward)
+
+    shape = list(depth.shape)
+    forward_jump = numpy.full(shape, numpy.inf, dtype=numpy.float32)
+    backward_jump = numpy.full(shape, numpy.inf, dtype=numpy.float32)
+    forward_jump[forward] = jump
+    backward_jump[backward] = jump
+    use_forward = forward_jump <= backward_jump
+
+    difference = numpy.zeros(depth.shape + (3,), dtype=numpy.float32)
+    difference[forward] = step
+    backward_difference = numpy.zeros_like(difference)
+    backward_difference[backward] = step
+    numpy.copyto(difference, backward_difference, where=~use_forward[:, :, numpy.newaxis])
+    valid = numpy.minimum(forward_jump, backward_jump) <= max_jump
+    return difference, valid
+
+
+def surface_normals(depth, intrinsics, max_jump=0.05, max_depth=FAR_DEPTH):
+    """
+    Return the (height, width, 3) float32 unit normals, in camera coordinates
+    and facing the camera, of a depth map (z in meters) and the (height,
+    width) valid mask. A difference is a depth edge if its depth jump is more
+    than max_jump times the depth, pixels at or beyond max_depth are invalid.
+    """
+    depth = numpy.asarray(depth, dtype=numpy.float32)
+    points = geometry.back_project(depth, intrinsics)
+    max_jump = max_jump * depth
+    du, valid_u = _difference(points, depth, 1, max_jump)
+    dv, valid_v = _difference(points, depth, 0, max_jump)
+    normals = numpy.cross(dv, du)
+    # Face the camera.
+    facing = numpy.einsum('ijk,ijk->ij', normals, points)
+    normals[facing > 0.0] *= -1.0
+    norm = numpy.sqrt(numpy.einsum('ijk,ijk->ij', normals, normals))
+    valid = valid_u & valid_v & (depth < max_depth) & (norm > 0.0)
+    norm[~valid] = 1.0
+    normals /= norm[:, :, numpy.newaxis]
+    normals[~valid] = 0.0
+    return normals, valid
+
+
+def encode_normals(normals, valid):
+    """
+    Encode normals as an RGB png, (n + 1) * 127.5 per component and 0 for
+    invalid pixels, returns the extension and the bytes.
+    """
+    encoded = numpy.rint((normals + 1.0) * 127.5)
+    encoded[~valid] = 0.0
+    buffer = io.BytesIO()
+    PImage.fromarray(encoded.astype(numpy.uint8), mode='RGB').save(buffer, format='PNG')
+    return '.png', buffer.getvalue()
+
+
+def decode_normals(image):
+    """Return the unit normals and the valid mask of an (height, width, 3) uint8 normal image."""
+    valid = image.any(axis=2)
+    normals = image.astype(numpy.float32) / 127.5 - 1.0
+    normals /= numpy.maximum(numpy.sqrt((normals ** 2).sum(axis=2)), 1e-6)[:, :, numpy.newaxis]
+    normals[~valid] = 0.0
+    return normals, valid
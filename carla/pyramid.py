@@ -0,0 +1,78 @@
+"""
+Multi-resolution outputs.
+
+build_pyramid downsamples one decoded camera image by integer factors. Color
+images are area-downsampled, every output pixel being the mean of its block.
+Depth and segmentation labels cannot be averaged across object edges, so
+they keep the block center sample, which also keeps invalid pixels (sky)
+invalid; the disparity of a level is divided by its factor when saved.
+"""
+
+import io
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from PIL import Image as PImage
+
+from .sensor import encode_depth
+
+
+def area_downsample(array, factor):
+    """
+    Downsample a (height, width[, channels]) uint8 array by an integer factor,
+    averaging blocks of factor x factor pixels. Incomplete blocks at the
+    right and bottom borders are dropped.
+    """
+    height, width = array.shape[0] // factor, array.shape[1] // factor
+    # Sum the factor x factor strided views of the blocks, several times
+    # faster than reducing a (height, factor, width, factor) reshape.
+    total = numpy.zeros((height, width) + array.shape[2:], dtype=numpy.uint32)
+    for row in range(factor):
+        for column in range(factor):
+            total += array[row:height * factor:factor, column:width * factor:factor]
+    area = factor * factor
+    total += area // 2
+    total //= area
+    return total.astype(array.dtype)
+
+
+def nearest_downsample(array, factor):
+    """Downsample an array by an integer factor, keeping the center sample of every block."""
+    height, width = array.shape[0] // factor, array.shape[1] // factor
+    offset = factor // 2
+    return array[offset:height * factor:factor, offset:width * factor:factor]
+
+
+class PyramidLevel(object):
+    """
+    An image downsampled by factor, array holding the RGB colors, the depth
+    in meters or the segmentation labels depending on image_type, the type of
+    a sensor.Image. It is saved like the original image.
+    """
+
+    def __init__(self, image_type, array, factor):
+        self.type = image_type
+        self.array = array
+        self.factor = factor
+
+    def encode(self, process=None, format=None, max_depth=None):
+        """Encode the level in memory like sensor.Image.encode."""
+        if self.type == 'Depth':
+            def scaled(depth):
+                return process(depth) / self.factor
+            return encode_depth(self.array, scaled if process else None, format, max_depth)
+        buffer = io.BytesIO()
+        PImage.fromarray(numpy.ascontiguousarray(self.array)).save(buffer, format='PNG')
+        return '.png', buffer.getvalue()
+
+
+def build_pyramid(image_type, array, factors):
+    """
+    Return the PyramidLevel of every factor of an image, see PyramidLevel.
+    All the levels are computed from array, the image decoded once.
+    """
+    downsample = nearest_downsample if image_type in ('Depth', 'SemanticSegmentation') else area_downsample
+    return [PyramidLevel(image_type, downsample(array, factor), factor) for factor in factors]
@@ -7,6 +7,7 @@
 """CARLA sensors."""
 
 
+import io
 import os
 import sys
 sys.path.append("..")
@@ -37,10 +38,107 @@ Point = namedtuple('Point', 'x y z color')
 Point.__new__.__defaults__ = (0.0, 0.0, 0.0, None)
 
 
+# Depth of the far plane (sky) in meters, depth images are normalized by it.
+FAR_DEPTH = 1000.0
+
+
 def _append_extension(filename, ext):
     return filename if filename.lower().endswith(ext.lower()) else filename + ext
 
 
+def _write_file(filename, payload):
+    # Create folder to save if does not exist.
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(filename, 'wb') as output_file:
+        output_file.write(payload)
+
+
+def _point_dtype(has_colors):
+    """Record layout of a point in binary PLY and npy point-clouds."""
+    fields = [('xyz', '<f4', (3,))]
+    if has_colors:
+        fields.append(('rgb', 'u1', (3,)))
+    return numpy.dtype(fields)
+
+
+def _voxel_groups(array, voxel_size):
+    """
+    Group the points of a (N, 3) array by voxel. Returns the indices of the
+    points sorted by voxel and the index in this order of the first point of
+    every voxel.
+    """
+    # Linear voxel keys over the bounding box of the points.
+    key = None
+    for axis in range(3):
+        # Floor and shift in floating point, in place, converting only the
+        # final voxel indices.
+        coordinate = array[:, axis] * (1.0 / voxel_size)
+        numpy.floor(coordinate, out=coordinate)
+        coordinate -= coordinate.min()
+        size = int(coordinate.max()) + 1
+        coordinate = coordinate.astype(numpy.int64)
+        if key is None:
+            key = coordinate
+        else:
+            key *= size
+            key += coordinate
+    # Sorting the keys packed with the point indices is much faster than an
+    # argsort, if they fit in 63 bits.
+    bits = len(key).bit_length()
+    if int(key.max()) < (1 << (63 - bits)):
+        key <<= bits
+        key |= numpy.arange(len(key))
+        key.sort()
+        order = key & ((1 << bits) - 1)
+        key >>= bits
+    else:
+        order = numpy.argsort(key)
+        key = key[order]
+    first = numpy.empty(len(key), dtype=bool)
+    first[0] = True
+    numpy.not_equal(key[1:], key[:-1], out=first[1:])
+    return order, numpy.flatnonzero(first)
+
+
+def _to_kitti_disparity(disparity, valid):
+    """Quantize a disparity map to KITTI's uint16 encoding (disparity * 256,
+    0 meaning invalid). Disparities too large for 16 bits are invalid."""
+    valid = numpy.logical_and(valid, numpy.isfinite(disparity))
+    encoded = numpy.rint(numpy.where(valid, disparity, 0.0) * 256.0)
+    valid &= encoded <= 65535.0
+    numpy.clip(encoded, 1.0, 65535.0, out=encoded)
+    encoded[~valid] = 0.0
+    return encoded.astype(numpy.uint16)
+
+
+def encode_depth(depth, process=None, format=None, max_depth=None):
+    """
+    Encode a depth map in meters, see Image.encode. Pixels at an infinite
+    depth are invalid in KITTI disparity maps, like the sky.
+    """
+    data = process(depth) if process else depth
+    buffer = io.BytesIO()
+    if format == 'pfm' or format is None:
+        extension = '.pfm'
+        python_pfm.writePFM(buffer, data)
+    elif format == 'png':
+        extension = '.png'
+        image = PImage.fromarray(data.astype('uint8'))
+        image.save(buffer, format='PNG')
+    elif format == 'kitti':
+        # KITTI disp_occ encoding: uint16 png, disparity * 256,
+        # 0 for invalid pixels (sky and beyond max_depth).
+        extension = '.png'
+        valid = depth < (FAR_DEPTH if max_depth is None else min(max_depth, FAR_DEPTH))
+        image = PImage.fromarray(_to_kitti_disparity(data, valid))
+        image.save(buffer, format='PNG')
+    else:
+        raise ValueError('sensor.encode_depth: unknown depth format %r' % format)
+    return extension, buffer.getvalue()
+
+
 # ==============================================================================
 # -- Sensor --------------------------------------------------------------------
 # ==============================================================================
@@ -177,41 +275,52 @@ class Image(SensorData):
         return self._converted_data
 
     # added parameters process and format'
-    # Param process only works with format 'pfm'
-    def save_to_disk(self, filename, process=None, format=None):
-        folder = os.path.dirname(filename)
-        if not os.path.isdir(folder):
-            os.makedirs(folder)
+    # Param process only works with format 'pfm' and 'kitti'
+    # Param max_depth (in meters) only works with format 'kitti'
+    def encode(self, process=None, format=None, max_depth=None):
+        """
+        Encode this image in memory, returns a pair containing the file
+        extension and the encoded bytes.
+        """
         if self.type == 'Depth':
-            data = self.data * 1000
-            if process:
-                data = process(data)
-
-            if format == 'pfm' or format is None:
-                filename = _append_extension(filename, '.pfm')
-                python_pfm.writePFM(filename, data)
-            elif format == 'png':
-                filename = _append_extension(filename, '.png')
-                image = PImage.fromarray(data.astype('uint8'))
-                image.save(filename)
-            else:
-                # TODO: throw exception
-                pass
+            return encode_depth(self.data * FAR_DEPTH, process, format, max_depth)
+
+        buffer = io.BytesIO()
+        if self.type == 'SemanticSegmentation':
+            # Single channel png of the labels, a view of the red channel.
+            PImage.fromarray(self.data, mode='L').save(buffer, format='PNG')
+            return '.png', buffer.getvalue()
+
+        image = PImage.frombytes(
+            mode='RGBA',
+            size=(self.width, self.height),
+            data=self.raw_data,
+            decoder_name='raw')
+        color = image.split()
+        image = PImage.merge("RGB", color[2::-1])
+
+        image.save(buffer, format='PNG')
+
+        return '.png', buffer.getvalue()
+
+    def save_to_disk(self, filename, process=None, format=None, max_depth=None):
+        """Save this image to disk (requires PIL installed)."""
+        extension, payload = self.encode(process, format, max_depth)
+        _write_file(_append_extension(filename, extension), payload)
 
-        else:
-            """Save this image to disk (requires PIL installed)."""
-            filename = _append_extension(filename, '.png')
 
-            image = PImage.frombytes(
-                mode='RGBA',
-                size=(self.width, self.height),
-                data=self.raw_data,
-                decoder_name='raw')
-            color = image.split()
-            image = PImage.merge("RGB", color[2::-1])
+class DepthMap(object):
+    """
+    A depth map already decoded to meters, saved like a depth Image without
+    decoding the raw image again.
+    """
 
-            image.save(filename)
+    def __init__(self, depth):
+        self.depth = depth
 
+    def encode(self, process=None, format=None, max_depth=None):
+        """Encode the depth map in memory like Image.encode."""
+        return encode_depth(self.depth, process, format, max_depth)
 
 
 class PointCloud(SensorData):
@@ -250,21 +359,110 @@ class PointCloud(SensorData):
         """Return whether the points have color."""
         return self._has_colors
 
+    @property
+    def x(self):
+        """View of the X coordinates of the points."""
+        return self._array[:, 0]
+
+    @property
+    def y(self):
+        """View of the Y coordinates of the points."""
+        return self._array[:, 1]
+
+    @property
+    def z(self):
+        """View of the Z coordinates of the points."""
+        return self._array[:, 2]
+
+    def ranges(self):
+        """Return the distance of every point to the origin."""
+        return numpy.sqrt(numpy.einsum('ij,ij->i', self._array, self._array))
+
+    def filter(self, mask):
+        """
+        Return a new PointCloud with the points selected by mask, a boolean
+        array, an index array or a slice (which keeps sharing memory).
+        """
+        color_array = None if self._color_array is None else self._color_array[mask]
+        return PointCloud(self.frame_number, self._array[mask], color_array=color_array)
+
+    @staticmethod
+    def concatenate(point_clouds):
+        """
+        Concatenate a sequence of PointCloud, colors are kept only if all of
+        them have colors. An empty sequence gives an empty PointCloud.
+        """
+        point_clouds = list(point_clouds)
+        if not point_clouds:
+            return PointCloud(0, numpy.zeros((0, 3), dtype=numpy.float32))
+        array = numpy.concatenate([pc.array for pc in point_clouds])
+        color_array = None
+        if all(pc.has_colors() for pc in point_clouds):
+            color_array = numpy.concatenate([pc.color_array for pc in point_clouds])
+        return PointCloud(point_clouds[0].frame_number, array, color_array=color_array)
+
+    def voxel_downsample(self, voxel_size):
+        """
+        Return a new PointCloud with one point per occupied voxel of the given
+        size, the average of the points (and colors) falling into it.
+        """
+        if len(self) == 0:
+            return self.filter(slice(None))
+        order, first = _voxel_groups(self._array, voxel_size)
+        scale = 1.0 / numpy.diff(numpy.append(first, len(order))).astype(numpy.float32)
+        scale = scale[:, numpy.newaxis]
+        # Sum the contiguous runs of the points sorted by voxel, all the
+        # columns at once. take is much faster than fancy indexing rows.
+        array = numpy.add.reduceat(
+            numpy.take(self._array, order, axis=0), first, axis=0, dtype=numpy.float32)
+        array *= scale
+        color_array = None
+        if self._has_colors:
+            colors = numpy.add.reduceat(
+                numpy.take(self._color_array, order, axis=0), first, axis=0, dtype=numpy.uint32)
+            colors = colors.astype(numpy.float32)
+            colors *= scale
+            color_array = numpy.rint(colors, out=colors).astype(numpy.uint8)
+        return PointCloud(self.frame_number, array, color_array=color_array)
+
+    def crop_range(self, min_range=0.0, max_range=numpy.inf):
+        """Return the points whose distance to the origin is within [min_range, max_range]."""
+        squared = numpy.einsum('ij,ij->i', self._array, self._array)
+        return self._select((squared >= min_range * min_range) & (squared <= max_range * max_range))
+
+    def crop_box(self, min_bound, max_bound):
+        """Return the points inside the axis-aligned box [min_bound, max_bound]."""
+        mask = numpy.ones(len(self), dtype=bool)
+        for axis in range(3):
+            coordinate = self._array[:, axis]
+            mask &= (coordinate >= min_bound[axis]) & (coordinate <= max_bound[axis])
+        return self._select(mask)
+
+    def _select(self, mask):
+        # Share memory if nothing is filtered out.
+        return self.filter(slice(None) if mask.all() else mask)
+
     def apply_transform(self, transformation):
         """Modify the PointCloud instance transforming its points"""
         self._array = transformation.transform_points(self._array)
 
-    def save_to_disk(self, filename):
-        """Save this point-cloud to disk as PLY format."""
-        filename = _append_extension(filename, '.ply')
+    def encode(self, format=None):
+        """
+        Encode this point-cloud in memory, returns a pair containing the file
+        extension and the encoded bytes.
 
-        def construct_ply_header():
+        Formats: 'ply' (ASCII PLY, default), 'binary_ply' (little-endian
+        binary PLY), 'bin' (KITTI velodyne float32 x,y,z,intensity, with zero
+        intensity and without colors) and 'npy' (see _point_dtype).
+        """
+
+        def construct_ply_header(ply_format):
             """Generates a PLY header given a total number of 3D points and
             coloring property if specified
             """
             points = len(self)  # Total point number
             header = ['ply',
-                      'format ascii 1.0',
+                      'format {} 1.0',
                       'element vertex {}',
                       'property float32 x',
                       'property float32 y',
@@ -274,31 +472,55 @@ class PointCloud(SensorData):
                       'property uchar diffuse_blue',
                       'end_header']
             if not self._has_colors:
-                return '\n'.join(header[0:6] + [header[-1]]).format(points)
-            return '\n'.join(header).format(points)
-
-        if not self._has_colors:
-            ply = '\n'.join(['{:.2f} {:.2f} {:.2f}'.format(
-                *p) for p in self._array.tolist()])
-        else:
-            points_3d = numpy.concatenate(
-                (self._array, self._color_array), axis=1)
-            ply = '\n'.join(['{:.2f} {:.2f} {:.2f} {:.0f} {:.0f} {:.0f}'
-                             .format(*p) for p in points_3d.tolist()])
+                return '\n'.join(header[0:6] + [header[-1]]).format(ply_format, points)
+            return '\n'.join(header).format(ply_format, points)
 
-        # Create folder to save if does not exist.
-        folder = os.path.dirname(filename)
-        if not os.path.isdir(folder):
-            os.makedirs(folder)
-
-        # Open the file and save with the specific PLY format.
-        with open(filename, 'w+') as ply_file:
-            ply_file.write('\n'.join([construct_ply_header(), ply]))
+        if format == 'ply' or format is None:
+            if not self._has_colors:
+                ply = '\n'.join(['{:.2f} {:.2f} {:.2f}'.format(
+                    *p) for p in self._array.tolist()])
+            else:
+                points_3d = numpy.concatenate(
+                    (self._array, self._color_array), axis=1)
+                ply = '\n'.join(['{:.2f} {:.2f} {:.2f} {:.0f} {:.0f} {:.0f}'
+                                 .format(*p) for p in points_3d.tolist()])
+
+            return '.ply', '\n'.join([construct_ply_header('ascii'), ply]).encode('ascii')
+        elif format == 'binary_ply':
+            header = construct_ply_header('binary_little_endian') + '\n'
+            return '.ply', header.encode('ascii') + self.to_structured().tobytes()
+        elif format == 'bin':
+            scan = numpy.zeros((len(self), 4), dtype='<f4')
+            scan[:, :3] = self._array
+            return '.bin', scan.tobytes()
+        elif format == 'npy':
+            buffer = io.BytesIO()
+            numpy.save(buffer, self.to_structured())
+            return '.npy', buffer.getvalue()
+        raise ValueError('sensor.PointCloud: unknown format %r' % format)
+
+    def save_to_disk(self, filename, format=None):
+        """Save this point-cloud to disk, PLY format by default (see encode)."""
+        extension, payload = self.encode(format)
+        _write_file(_append_extension(filename, extension), payload)
+
+    def to_structured(self):
+        """
+        Return the points (and colors) as a numpy structured array with an
+        'xyz' float32 field and, if there are colors, an 'rgb' uint8 field.
+        """
+        records = numpy.empty(len(self), dtype=_point_dtype(self._has_colors))
+        records['xyz'] = self._array
+        if self._has_colors:
+            records['rgb'] = self._color_array
+        return records
 
     def __len__(self):
         return len(self.array)
 
     def __getitem__(self, key):
+        if isinstance(key, (slice, list, numpy.ndarray)):
+            return self.filter(key)
         color = None if self._color_array is None else Color(
             *self._color_array[key])
         return Point(*self._array[key], color=color)
@@ -336,6 +558,10 @@ class LidarMeasurement(SensorData):
         self.channels = channels
         self.point_count_by_channel = point_count_by_channel
         self.point_cloud = point_cloud
+        # Points of channel i are in [channel_offsets[i], channel_offsets[i + 1]).
+        self.channel_offsets = numpy.zeros(channels + 1, dtype=numpy.int64)
+        numpy.cumsum(point_count_by_channel, out=self.channel_offsets[1:])
+        self._channel_ids = None
 
     @property
     def data(self):
@@ -348,6 +574,77 @@ class LidarMeasurement(SensorData):
         """
         return self.point_cloud.array
 
-    def save_to_disk(self, filename):
-        """Save point-cloud to disk as PLY format."""
-        self.point_cloud.save_to_disk(filename)
+    @property
+    def channel_ids(self):
+        """The channel of every point of the point-cloud, computed once."""
+        if self._channel_ids is None:
+            self._channel_ids = numpy.repeat(
+                numpy.arange(self.channels, dtype=numpy.uint16),
+                self.point_count_by_channel)
+        return self._channel_ids
+
+    def channel(self, index):
+        """Return the points of the given channel as a PointCloud sharing memory."""
+        return self.point_cloud[self.channel_offsets[index]:self.channel_offsets[index + 1]]
+
+    def channel_arrays(self):
+        """Return the list of per-channel views of the point-cloud array."""
+        return numpy.split(self.point_cloud.array, self.channel_offsets[1:-1])
+
+    def encode(self, format=None):
+        """Encode point-cloud in memory, PLY format by default."""
+        return self.point_cloud.encode(format)
+
+    def save_to_disk(self, filename, format=None):
+        """Save point-cloud to disk, PLY format by default."""
+        self.point_cloud.save_to_disk(filename, format)
+
+
+def load_point_cloud(filename, frame_number=0):
+    """
+    Load a point-cloud saved by PointCloud.save_to_disk. Binary PLY, KITTI
+    .bin and .npy files are memory-mapped, the returned arrays are read-only
+    views of the file.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.bin':
+        if os.path.getsize(filename) == 0:
+            # Empty files cannot be memory-mapped.
+            return PointCloud(frame_number, numpy.zeros((0, 3), dtype=numpy.float32))
+        scan = numpy.memmap(filename, dtype='<f4', mode='r').reshape((-1, 4))
+        return PointCloud(frame_number, scan[:, :3])
+    elif extension == '.npy':
+        records = numpy.load(filename, mmap_mode='r')
+    elif extension == '.ply':
+        records = _read_ply(filename)
+    else:
+        raise ValueError('sensor: cannot load point-cloud %r' % filename)
+    colors = records['rgb'] if 'rgb' in records.dtype.names else None
+    return PointCloud(frame_number, records['xyz'], color_array=colors)
+
+
+def _read_ply(filename):
+    with open(filename, 'rb') as ply_file:
+        header = []
+        while not header or header[-1] != 'end_header':
+            line = ply_file.readline()
+            if not line:
+                raise ValueError('sensor: malformed PLY file %r' % filename)
+            header.append(line.decode('ascii').strip())
+        offset = ply_file.tell()
+        points = int([h for h in header if h.startswith('element vertex')][0].split()[-1])
+        dtype = _point_dtype(any(h.endswith('diffuse_red') for h in header))
+        if 'format ascii 1.0' in header:
+            if points == 0:
+                return numpy.empty(0, dtype=dtype)
+            values = numpy.loadtxt(ply_file, ndmin=2)
+            records = numpy.empty(points, dtype=dtype)
+            records['xyz'] = values[:, :3]
+            if 'rgb' in dtype.names:
+                records['rgb'] = values[:, 3:6]
+            return records
+    if 'format binary_little_endian 1.0' not in header:
+        raise ValueError('sensor: unsupported PLY format in %r' % filename)
+    if points == 0:
+        return numpy.empty(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(points,))
@@ -0,0 +1,293 @@
+"""
+Output sinks for sensor data.
+
+A sink receives the encoded sensor data of every saved tick under a key (see
+archive.KEY_FORMAT) and stores it somewhere, or nowhere. Writing through a
+sink decouples the generation loop from the storage, so encoding cost can be
+measured apart from storage cost.
+"""
+
+import collections
+import errno
+import os
+
+from .archive import ShardWriter
+
+
+# Manifest of the ticks committed by a FileSystemSink, one per top folder.
+MANIFEST_FILENAME = 'committed.txt'
+
+
+def _fsync(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Folders cannot be opened on some platforms.
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _process_exists(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process, assume it is running.
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+def _manifest_folder(key):
+    # Top folder of key (the episode folder of archive.KEY_FORMAT keys).
+    return key.split('/', 1)[0] if '/' in key else ''
+
+
+def committed_keys(folder):
+    """
+    Return the set of the keys committed by FileSystemSinks in folder, the
+    files of the ticks interrupted by a killed process are not included.
+    """
+    keys = set()
+    manifests = [os.path.join(folder, MANIFEST_FILENAME)] + [
+        os.path.join(folder, name, MANIFEST_FILENAME) for name in sorted(os.listdir(folder))]
+    for manifest in manifests:
+        if not os.path.isfile(manifest):
+            continue
+        with open(manifest, 'r') as manifest_file:
+            for line in manifest_file:
+                # A line without its end was being written.
+                if line.endswith('\n'):
+                    keys.update(line.rstrip('\n').split('\t'))
+    return keys
+
+
+class Sink(object):
+    """Base class for output sinks."""
+
+    def add(self, key, payload):
+        """Store the bytes payload under key (with extension)."""
+        raise NotImplementedError
+
+    def save(self, key, measurement, *args, **kwargs):
+        """
+        Encode measurement and store it under key (without extension), the
+        extra arguments are forwarded to measurement.encode.
+        """
+        extension, payload = measurement.encode(*args, **kwargs)
+        self.add(key + extension, payload)
+
+    def commit(self):
+        """Called once all the data of a tick has been added."""
+        pass
+
+    def rollback(self):
+        """Drop the data added since the last commit."""
+        pass
+
+    def begin_episode(self, prefix):
+        """
+        Called when an episode, whose keys start with prefix, starts or is
+        generated again from its first tick.
+        """
+        pass
+
+    def end_episode(self):
+        """Called once all the ticks of an episode have been committed."""
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FileSystemSink(Sink):
+    """
+    Writes one file per key inside folder.
+
+    Files are written to hidden temporary names and renamed to their final
+    names on commit, so a killed process never leaves truncated files under
+    their final names. The keys of every committed tick are then appended, in
+    one write, as one line of the manifest of their top folder (see
+    committed_keys). The files of a tick interrupted by a killed process may
+    be partially renamed but are never listed, so the ticks appear together
+    to the readers checking the manifests.
+
+    Temporary names end with the id of the writing process. Temporary files
+    of processes that are no longer running are removed from the folders the
+    sink writes to, the first time it writes to each of them, so several
+    processes can share folder. Created folders are cached. The committed
+    files are flushed to disk at the end of each episode only, by a single
+    os.sync where available (or one fsync per file and folder otherwise),
+    so the last episode may be lost on power failure.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._folders = set()
+        self._pending = []
+        self._unsynced = set()
+
+    def add(self, key, payload):
+        filename = os.path.join(self.folder, key)
+        folder, basename = os.path.split(filename)
+        # Create folder to save if does not exist.
+        if folder not in self._folders:
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Already existing, or created by another process meanwhile.
+                if not os.path.isdir(folder):
+                    raise
+            self._remove_stale_files(folder)
+            self._folders.add(folder)
+        temp_filename = os.path.join(folder, '.%s.%d.tmp' % (basename, os.getpid()))
+        with open(temp_filename, 'wb') as output_file:
+            output_file.write(payload)
+        self._pending.append((temp_filename, filename, key))
+
+    def commit(self):
+        manifests = collections.OrderedDict()
+        for temp_filename, filename, key in self._pending:
+            os.replace(temp_filename, filename)
+            self._unsynced.add(filename)
+            manifests.setdefault(_manifest_folder(key), []).append(key)
+        self._pending = []
+        # Publish the tick once all its files are in place.
+        for folder, keys in manifests.items():
+            manifest = os.path.join(self.folder, folder, MANIFEST_FILENAME)
+            fd = os.open(manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, ('\t'.join(keys) + '\n').encode('utf-8'))
+            finally:
+                os.close(fd)
+            self._unsynced.add(manifest)
+
+    def rollback(self):
+        for temp_filename, _, _ in self._pending:
+            os.remove(temp_filename)
+        self._pending = []
+
+    def begin_episode(self, prefix):
+        # The ticks of a previous attempt are no longer complete.
+        manifest = os.path.join(self.folder, prefix, MANIFEST_FILENAME)
+        if os.path.isfile(manifest):
+            os.remove(manifest)
+
+    def end_episode(self):
+        """Flush the files committed so far and their folders to disk."""
+        if not self._unsynced:
+            return
+        if hasattr(os, 'sync'):
+            os.sync()
+        else:
+            for filename in self._unsynced:
+                _fsync(filename)
+            for folder in set(os.path.dirname(filename) for filename in self._unsynced):
+                _fsync(folder)
+        self._unsynced = set()
+
+    def close(self):
+        # Drop the files of an uncommitted tick.
+        self.rollback()
+        self.end_episode()
+
+    def _remove_stale_files(self, folder):
+        for filename in os.listdir(folder):
+            if not (filename.startswith('.') and filename.endswith('.tmp')):
+                continue
+            pid = filename.rsplit('.', 2)[-2]
+            if pid.isdigit() and (int(pid) == os.getpid() or _process_exists(int(pid))):
+                continue
+            try:
+                os.remove(os.path.join(folder, filename))
+            except OSError:
+                # Removed by another process meanwhile.
+                pass
+
+
+class ShardSink(Sink):
+    """Appends to the tar shards of an archive.ShardWriter."""
+
+    def __init__(self, folder, max_shard_size=1 << 30):
+        self.writer = ShardWriter(folder, max_shard_size)
+
+    def add(self, key, payload):
+        self.writer.add(key, payload)
+
+    def commit(self):
+        self.writer.flush()
+
+    def rollback(self):
+        self.writer.discard()
+
+    def close(self):
+        self.writer.close()
+
+
+class NullSink(Sink):
+    """
+    Discards everything. If encode is False measurements are not even encoded,
+    only counted.
+    """
+
+    def __init__(self, encode=True):
+        self.encode = encode
+        self.count = 0
+        self.bytes = 0
+
+    def add(self, key, payload):
+        self.count += 1
+        self.bytes += len(payload)
+
+    def save(self, key, measurement, *args, **kwargs):
+        if self.encode:
+            super(NullSink, self).save(key, measurement, *args, **kwargs)
+        else:
+            self.count += 1
+
+
+class MemorySink(Sink):
+    """Keeps the last capacity (key, payload) pairs in memory."""
+
+    def __init__(self, capacity=64):
+        self.items = collections.deque(maxlen=capacity)
+
+    def add(self, key, payload):
+        self.items.append((key, payload))
+
+    def get(self, key):
+        """Return the latest payload stored under key, None if not found."""
+        for item_key, payload in reversed(self.items):
+            if item_key == key:
+                return payload
+        return None
+
+    def __len__(self):
+        return len(self.items)
+
+
+SINKS = ['files', 'shards', 'memory', 'null', 'drop']
+
+
+def make_sink(name, folder, max_shard_size=1 << 30, capacity=64):
+    """Create the sink called name (see SINKS) writing to folder."""
+    if name == 'files':
+        return FileSystemSink(folder)
+    elif name == 'shards':
+        return ShardSink(folder, max_shard_size)
+    elif name == 'memory':
+        return MemorySink(capacity)
+    elif name == 'null':
+        return NullSink(encode=True)
+    elif name == 'drop':
+        return NullSink(encode=False)
+    raise ValueError('sink: no sink named %r' % name)
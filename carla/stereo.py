@@ -0,0 +1,111 @@
+"""
+Stereo helpers for the rectified camera pair.
+
+Left pixel (x, y) of disparity d sees the same point as right pixel (x - d, y).
+forward_warp scatters the left disparity into the right view keeping, like a
+z-buffer, the nearest point of every right pixel and closing the 1-pixel
+cracks left by rounding, WarpedDepth uses it to synthesize the right depth
+map without rendering it. occlusion_masks compares both views to find the
+pixels with no correspondence in the other view. Masks are stored
+bit-packed, one bit per pixel.
+"""
+
+import io
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from . import geometry
+from .sensor import DepthMap
+
+
+def forward_warp(disparity, valid=None, crack_threshold=1.0):
+    """
+    Warp a (height, width) left disparity map into the right view. Returns the
+    right disparity map, 0 where no left pixel lands (the holes), and the
+    linear index of the left pixel kept for every right pixel, -1 for holes.
+
+    Rounding the target columns leaves 1-pixel cracks in the surfaces
+    stretched by the warp. A hole between two pixels of the same row whose
+    disparities differ by at most crack_threshold is such a crack, it takes
+    the nearer of them. Wider holes and holes at depth edges are kept.
+    """
+    height, width = disparity.shape
+    columns = numpy.arange(width, dtype=numpy.float32) - disparity
+    target = numpy.rint(columns).astype(numpy.int64)
+    inside = (target >= 0) & (target < width)
+    if valid is not None:
+        inside &= valid
+    source = numpy.flatnonzero(inside)
+    pixel = target.ravel()[source] + (source // width) * width
+    # The nearest point has the largest disparity.
+    nearest, index = geometry.z_buffer(pixel, -disparity.ravel()[source], height * width)
+    warped = (-nearest).reshape((height, width))
+    index = numpy.where(index >= 0, source[numpy.maximum(index, 0)], -1).reshape((height, width))
+
+    # Close the cracks, both neighbours set and on the same surface.
+    hole = index < 0
+    left, right = warped[:, :-2], warped[:, 2:]
+    crack = hole[:, 1:-1] & ~hole[:, :-2] & ~hole[:, 2:] & (numpy.abs(left - right) <= crack_threshold)
+    use_left = left >= right
+    fill = numpy.where(use_left, left, right)[crack]
+    fill_index = numpy.where(use_left, index[:, :-2], index[:, 2:])[crack]
+    warped[:, 1:-1][crack] = fill
+    index[:, 1:-1][crack] = fill_index
+    return warped, index
+
+
+class WarpedDepth(DepthMap):
+    """
+    Right depth map (in meters) forward-warped from the left one, for a rig
+    of the given focal length times baseline (in pixels times meters). The
+    holes, the right pixels seen by no left pixel, get an infinite depth and
+    are flagged in holes. warp keeps the forward_warp result of the left
+    disparity for occlusion_masks. It is saved like a depth sensor.Image.
+    """
+
+    def __init__(self, left_depth, focal_baseline):
+        self.warp = forward_warp(focal_baseline / left_depth)
+        index = self.warp[1]
+        self.holes = index < 0
+        super(WarpedDepth, self).__init__(
+            numpy.where(self.holes, numpy.inf, left_depth.ravel()[index.ravel()].reshape(index.shape)))
+
+
+def occlusion_masks(left_disparity, right_disparity, threshold=1.0, warp=None):
+    """
+    Return the (height, width) occlusion masks of the left and right views,
+    True for the pixels not seen by the other camera: left pixels landing
+    outside the right image or on a right disparity more than threshold
+    pixels away, right pixels no left pixel lands on consistently. warp is
+    the forward_warp of left_disparity if already computed, e.g. the warp of
+    a WarpedDepth.
+    """
+    height, width = left_disparity.shape
+    target = numpy.rint(numpy.arange(width, dtype=numpy.float32) - left_disparity).astype(numpy.int64)
+    inside = (target >= 0) & (target < width)
+    numpy.clip(target, 0, width - 1, out=target)
+    seen = right_disparity[numpy.arange(height)[:, numpy.newaxis], target]
+    left_occluded = ~inside | (numpy.abs(seen - left_disparity) > threshold)
+
+    warped, index = forward_warp(left_disparity) if warp is None else warp
+    right_occluded = (index < 0) | (numpy.abs(warped - right_disparity) > threshold)
+    return left_occluded, right_occluded
+
+
+def encode_mask(mask):
+    """Encode a boolean mask bit-packed along rows as npy, returns the extension and the bytes."""
+    buffer = io.BytesIO()
+    numpy.save(buffer, numpy.packbits(mask, axis=-1))
+    return '.npy', buffer.getvalue()
+
+
+def unpack_mask(packed, width=None):
+    """
+    Return the boolean mask of a bit-packed one, see encode_mask. width is
+    the width of the mask, by default 8 times the packed width.
+    """
+    mask = numpy.unpackbits(packed, axis=-1).astype(bool)
+    return mask if width is None else mask[..., :width]
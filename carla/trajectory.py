@@ -0,0 +1,108 @@
+"""
+Ego trajectories.
+
+PoseRecorder stores the player transform, speed, acceleration and timestamps
+of every saved frame in a compact structured array (POSE_DTYPE). The helpers
+below turn it into pose matrices, relative poses between frame pairs and
+KITTI odometry poses, 3x4 camera-to-first-camera matrices in camera
+coordinates (x right, y down, z forward).
+"""
+
+import io
+
+try:
+    import numpy
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed.')
+
+from . import geometry
+from .transform import transform_matrices
+
+
+POSE_DTYPE = numpy.dtype([
+    ('frame', '<u4'),
+    ('frame_number', '<u8'),
+    ('platform_timestamp', '<u4'),
+    ('game_timestamp', '<u4'),
+    ('location', '<f8', (3,)),
+    ('rotation', '<f4', (3,)),
+    ('forward_speed', '<f4'),
+    ('acceleration', '<f4', (3,))])
+
+
+class PoseRecorder(object):
+    """Records the player pose of the saved frames of an episode."""
+
+    def __init__(self):
+        self._records = []
+
+    def append(self, measurements, frame):
+        """Record the player measurements of a saved frame."""
+        player = measurements.player_measurements
+        transform = player.transform
+        self._records.append((
+            frame,
+            measurements.frame_number,
+            measurements.platform_timestamp,
+            measurements.game_timestamp,
+            (transform.location.x, transform.location.y, transform.location.z),
+            (transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll),
+            player.forward_speed,
+            (player.acceleration.x, player.acceleration.y, player.acceleration.z)))
+
+    @property
+    def array(self):
+        """The recorded poses as a structured array of POSE_DTYPE."""
+        return numpy.array(self._records, dtype=POSE_DTYPE)
+
+    def encode(self):
+        """Encode the recorded poses in memory as npy, see sink.Sink.save."""
+        buffer = io.BytesIO()
+        numpy.save(buffer, self.array)
+        return '.npy', buffer.getvalue()
+
+    def __len__(self):
+        return len(self._records)
+
+
+def pose_matrices(poses, camera=None):
+    """
+    Return the (N, 4, 4) world poses of an array of POSE_DTYPE. Without
+    camera, the poses of the player vehicle in Unreal coordinates. With a
+    sensor.Camera, the poses of the camera in camera coordinates.
+    """
+    matrices = transform_matrices(poses['location'], poses['rotation'])
+    if camera is None:
+        return matrices
+    camera_to_car = numpy.linalg.inv(geometry.car_to_camera(camera))
+    return numpy.matmul(matrices, camera_to_car)
+
+
+def relative_poses(matrices, sources, targets):
+    """
+    Return the (K, 4, 4) poses of frames targets relative to frames sources,
+    inverse(matrices[sources]) * matrices[targets], for arrays of indices.
+    """
+    return numpy.matmul(numpy.linalg.inv(matrices[sources]), matrices[targets])
+
+
+def kitti_poses(poses, camera=None):
+    """
+    Return the (N, 3, 4) KITTI odometry poses of an array of POSE_DTYPE, the
+    poses of the camera (or of the vehicle, if no camera is given) relative to
+    the first frame, in camera coordinates.
+    """
+    if camera is None:
+        matrices = numpy.matmul(pose_matrices(poses), geometry.CAMERA_TO_UNREAL)
+    else:
+        matrices = pose_matrices(poses, camera)
+    count = len(matrices)
+    relative = relative_poses(matrices, numpy.zeros(count, dtype=numpy.intp), numpy.arange(count))
+    return relative[:, :3, :]
+
+
+def encode_kitti_poses(poses):
+    """Encode (N, 3, 4) poses as a KITTI poses.txt, one row-major pose per line."""
+    buffer = io.BytesIO()
+    numpy.savetxt(buffer, poses.reshape((-1, 12)), fmt='%.6e')
+    return '.txt', buffer.getvalue()
@@ -4,8 +4,6 @@
 # This work is licensed under the terms of the MIT license.
 # For a copy, see <https://opensource.org/licenses/MIT>.
 
-import math
-
 from collections import namedtuple
 
 try:
@@ -31,6 +29,64 @@ Scale = namedtuple('Scale', 'x y z')
 Scale.__new__.__defaults__ = (1.0, 1.0, 1.0)
 
 
+def transform_matrices(locations, rotations, scales=None, dtype=numpy.float64):
+    """
+    Build the (N, 4, 4) matrices of N transforms in one vectorized step.
+    locations are (N, 3) x, y, z, rotations (N, 3) pitch, yaw, roll in
+    degrees and scales (N, 3) x, y, z. See Transform.
+    """
+    locations = numpy.asarray(locations, dtype=numpy.float64).reshape((-1, 3))
+    rotations = numpy.radians(numpy.asarray(rotations, dtype=numpy.float64).reshape((-1, 3)))
+    if scales is None:
+        scales = numpy.ones_like(locations)
+    scales = numpy.asarray(scales, dtype=numpy.float64).reshape((-1, 3))
+    cp, cy, cr = numpy.cos(rotations).T
+    sp, sy, sr = numpy.sin(rotations).T
+    scale_x, scale_y, scale_z = scales.T
+    matrices = numpy.zeros((len(locations), 4, 4), dtype=numpy.float64)
+    matrices[:, 0, 3] = locations[:, 0]
+    matrices[:, 1, 3] = locations[:, 1]
+    matrices[:, 2, 3] = locations[:, 2]
+    matrices[:, 0, 0] = scale_x * (cp * cy)
+    matrices[:, 0, 1] = scale_y * (cy * sp * sr - sy * cr)
+    matrices[:, 0, 2] = -scale_z * (cy * sp * cr + sy * sr)
+    matrices[:, 1, 0] = scale_x * (sy * cp)
+    matrices[:, 1, 1] = scale_y * (sy * sp * sr + cy * cr)
+    matrices[:, 1, 2] = scale_z * (cy * sr - sy * sp * cr)
+    matrices[:, 2, 0] = scale_x * (sp)
+    matrices[:, 2, 1] = -scale_y * (cp * sr)
+    matrices[:, 2, 2] = scale_z * (cp * cr)
+    matrices[:, 3, 3] = 1.0
+    return matrices.astype(dtype, copy=False)
+
+
+def protobuf_transform_arrays(transforms):
+    """
+    Return the (N, 3) locations and (N, 3) pitch, yaw, roll rotations of a
+    sequence of protobuf Transform.
+    """
+    values = numpy.array([
+        (t.location.x, t.location.y, t.location.z,
+         t.rotation.pitch, t.rotation.yaw, t.rotation.roll) for t in transforms],
+        dtype=numpy.float64).reshape((-1, 6))
+    return values[:, :3], values[:, 3:]
+
+
+def apply_transforms(matrices, points):
+    """
+    Transform (..., N, 3) points by a 4x4 matrix or by (..., 4, 4) matrices,
+    without building homogeneous coordinates. float32 points are transformed
+    in float32, anything else in float64.
+    """
+    points = numpy.asarray(points)
+    dtype = numpy.float32 if points.dtype == numpy.float32 else numpy.float64
+    points = points.astype(dtype, copy=False)
+    matrices = numpy.asarray(matrices, dtype=dtype)
+    rotations = matrices[..., :3, :3]
+    translations = matrices[..., numpy.newaxis, :3, 3]
+    return numpy.matmul(points, numpy.swapaxes(rotations, -1, -2)) + translations
+
+
 class Transform(object):
     """A 3D transformation.
 
@@ -39,7 +95,7 @@ class Transform(object):
 
     def __init__(self, *args, **kwargs):
         if 'matrix' in kwargs:
-            self.matrix = kwargs['matrix']
+            self.matrix = numpy.asarray(kwargs['matrix'])
             return
         if isinstance(args[0], carla_protocol.Transform):
             args = [
@@ -52,7 +108,7 @@ class Transform(object):
                     args[0].rotation.yaw,
                     args[0].rotation.roll)
             ]
-        self.matrix = numpy.matrix(numpy.identity(4))
+        self.matrix = numpy.identity(4)
         self.set(*args, **kwargs)
 
     def set(self, *args):
@@ -92,24 +148,8 @@ class Transform(object):
                     'Translation', 'Rotation' or 'Scale'")
 
         # Transformation matrix
-        cy = math.cos(numpy.radians(rotation.yaw))
-        sy = math.sin(numpy.radians(rotation.yaw))
-        cr = math.cos(numpy.radians(rotation.roll))
-        sr = math.sin(numpy.radians(rotation.roll))
-        cp = math.cos(numpy.radians(rotation.pitch))
-        sp = math.sin(numpy.radians(rotation.pitch))
-        self.matrix[0, 3] = translation.x
-        self.matrix[1, 3] = translation.y
-        self.matrix[2, 3] = translation.z
-        self.matrix[0, 0] = scale.x * (cp * cy)
-        self.matrix[0, 1] = scale.y * (cy * sp * sr - sy * cr)
-        self.matrix[0, 2] = -scale.z * (cy * sp * cr + sy * sr)
-        self.matrix[1, 0] = scale.x * (sy * cp)
-        self.matrix[1, 1] = scale.y * (sy * sp * sr + cy * cr)
-        self.matrix[1, 2] = scale.z * (cy * sr - sy * sp * cr)
-        self.matrix[2, 0] = scale.x * (sp)
-        self.matrix[2, 1] = -scale.y * (cp * sr)
-        self.matrix[2, 2] = scale.z * (cp * cr)
+        self.matrix = transform_matrices(
+            [translation], [(rotation.pitch, rotation.yaw, rotation.roll)], [scale])[0]
 
     def inverse(self):
         """Return the inverse transform."""
@@ -119,16 +159,9 @@ class Transform(object):
         """
         Given a 4x4 transformation matrix, transform an array of 3D points.
         Expected point foramt: [[X0,Y0,Z0],..[Xn,Yn,Zn]]
+        float32 points are transformed in float32.
         """
-        # Needed foramt: [[X0,..Xn],[Z0,..Zn],[Z0,..Zn]]. So let's transpose
-        # the point matrix.
-        points = points.transpose()
-        # Add 0s row: [[X0..,Xn],[Y0..,Yn],[Z0..,Zn],[0,..0]]
-        points = numpy.append(points, numpy.ones((1, points.shape[1])), axis=0)
-        # Point transformation
-        points = self.matrix * points
-        # Return all but last row
-        return points[0:3].transpose()
+        return apply_transforms(self.matrix, points)
 
     def __mul__(self, other):
         return Transform(matrix=numpy.dot(self.matrix, other.matrix))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""Convert raw captures of generate.py --raw to the final png/pfm layout."""
+
+from __future__ import print_function
+
+import argparse
+import io
+import multiprocessing
+import os
+import time
+
+import numpy
+
+from carla.archive import EPISODE_FORMAT, KEY_FORMAT
+from carla.capture import RawCaptureReader, list_episodes
+from carla.image_converter import SEGMENTATION_CLASSES, class_histogram
+from carla.sensor import FAR_DEPTH
+from carla.sink import MANIFEST_FILENAME, FileSystemSink
+from carla.stereo import WarpedDepth, encode_mask
+
+
+def convert_frames(job):
+    input_folder, output_folder, episode, frames = job
+    capture = RawCaptureReader(input_folder, episode)
+    metadata = capture.metadata
+    camfu = metadata['camfu']
+    cambaseline = metadata['cambaseline']
+
+    def disparity(depth):
+        return camfu * cambaseline / depth
+
+    sink = FileSystemSink(output_folder)
+    # pixels per class of the segmentation cameras over these frames
+    histograms = {}
+    for iframe in frames:
+        _, sensor_data = capture.read(iframe)
+        for name, measurement in sensor_data.items():
+            sink.save(KEY_FORMAT.format(episode, name, iframe), measurement,
+                      disparity, metadata['depth_format'], metadata['max_depth'])
+            if measurement.type == 'SemanticSegmentation':
+                if name not in histograms:
+                    histograms[name] = numpy.zeros(SEGMENTATION_CLASSES, dtype=numpy.int64)
+                histograms[name] += class_histogram(measurement)
+        if metadata.get('warp_right_depth'):
+            right = WarpedDepth(sensor_data['Camera2Depth'].data * FAR_DEPTH, camfu * cambaseline)
+            sink.save(KEY_FORMAT.format(episode, 'Camera3Depth', iframe), right,
+                      disparity, metadata['depth_format'], metadata['max_depth'])
+            extension, payload = encode_mask(right.holes)
+            sink.add(KEY_FORMAT.format(episode, 'Camera3Holes', iframe) + extension, payload)
+        sink.commit()
+    sink.end_episode()
+    return episode, len(frames), histograms
+
+
+def save_histograms(output_folder, episode, histograms):
+    """Save the segmentation histograms of an episode like generate.py."""
+    with FileSystemSink(output_folder) as sink:
+        for name, histogram in histograms.items():
+            buffer = io.BytesIO()
+            numpy.save(buffer, histogram)
+            sink.add(EPISODE_FORMAT.format(episode) + '/' + name + '_histogram.npy', buffer.getvalue())
+        sink.commit()
+
+
+def copy_episode_files(input_folder, output_folder, episode):
+    """
+    Copy the episode-level files (poses, agent log...) generate.py saved
+    beside the raw capture of an episode, returns the number of files.
+    """
+    episode_key = EPISODE_FORMAT.format(episode)
+    episode_folder = os.path.join(input_folder, episode_key)
+    if not os.path.isdir(episode_folder) or \
+            os.path.realpath(input_folder) == os.path.realpath(output_folder):
+        return 0
+    copied = 0
+    sink = FileSystemSink(output_folder)
+    for folder, _, filenames in os.walk(episode_folder):
+        for filename in filenames:
+            if filename.startswith('.') or filename == MANIFEST_FILENAME:
+                # Temporary file of an interrupted write, or the manifest the
+                # sink writes for the copied files.
+                continue
+            path = os.path.join(folder, filename)
+            with open(path, 'rb') as file:
+                sink.add(os.path.relpath(path, input_folder), file.read())
+            copied += 1
+    sink.commit()
+    sink.end_episode()
+    return copied
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument(
+        '-i', '--input-folder',
+        default='carla_kitti_raw',
+        type=str,
+        help='folder of the raw captures')
+    argparser.add_argument(
+        '-o', '--output-folder',
+        default='carla_kitti',
+        type=str,
+        help='output folder dir')
+    argparser.add_argument(
+        '-j', '--jobs',
+        default=multiprocessing.cpu_count(),
+        type=int,
+        help='number of worker processes (default: number of cores)')
+    argparser.add_argument(
+        '--chunk',
+        default=10,
+        type=int,
+        help='number of frames converted by a worker at a time')
+
+    args = argparser.parse_args()
+
+    jobs = []
+    remaining = {}
+    for episode in list_episodes(args.input_folder):
+        copy_episode_files(args.input_folder, args.output_folder, episode)
+        frames = list(range(len(RawCaptureReader(args.input_folder, episode))))
+        for i in range(0, len(frames), args.chunk):
+            jobs.append((args.input_folder, args.output_folder, episode, frames[i:i + args.chunk]))
+        remaining[episode] = len(frames)
+
+    total = sum(len(job[3]) for job in jobs)
+    print('%d frames will be converted...' % total)
+    tic = time.time()
+    done = 0
+    episode_histograms = dict((episode, {}) for episode in remaining)
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        for episode, converted, histograms in pool.imap_unordered(convert_frames, jobs):
+            done += converted
+            for name, histogram in histograms.items():
+                total_histogram = episode_histograms[episode].setdefault(name, histogram)
+                if total_histogram is not histogram:
+                    total_histogram += histogram
+            remaining[episode] -= converted
+            if remaining[episode] == 0:
+                save_histograms(args.output_folder, episode, episode_histograms.pop(episode))
+            print('%d/%d frames, time left: %.2f' % (
+                done, total, (time.time() - tic) / 3600 * (total - done) / done))
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('\nCancelled by user. Bye!')
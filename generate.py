@@ -3,20 +3,37 @@
 from __future__ import print_function
 
 import argparse
+import io
 import logging
 import random
 import time
 import os
 import math
 
+import numpy
+
+from carla.agents import AgentLog, extract_agents
+from carla.bev import BevRasterizer
+from carla.archive import EPISODE_FORMAT, KEY_FORMAT
+from carla.capture import RawCaptureWriter
 from carla.client import make_carla_client
-from carla.sensor import Camera, Lidar
+from carla.flow import DisparityChangeGenerator, FlowGenerator, encode_kitti_flow, encode_pfm
+from carla.image_converter import SEGMENTATION_CLASSES, class_histogram
+from carla.geometry import back_project, car_to_camera, intrinsics_from_camera
+from carla.labels import LabelGenerator, encode_labels
+from carla.normals import encode_normals, surface_normals
+from carla.pyramid import build_pyramid
+from carla.sensor import FAR_DEPTH, Camera, DepthMap, Lidar, PointCloud
 from carla.settings import CarlaSettings
+from carla.sink import SINKS, make_sink
+from carla.stereo import WarpedDepth, encode_mask, occlusion_masks
 from carla.tcp import TCPConnectionError
+from carla.transform import Transform
+from carla.trajectory import PoseRecorder, encode_kitti_poses, kitti_poses
 from carla.util import print_over_same_line
 
 
-def run_carla_client(args):
+def run_carla_client(args, sink):
     # camera settings
     camcoor_x = 0.27
     camcoor_y = -0.06
@@ -28,114 +45,267 @@ def run_carla_client(args):
     camfu = 718.856 * args.scale
     camFOV = 2 * math.atan2(resolution_w, 2 * camfu) * 180 / math.pi
 
-    # weather settings
-    weathers = [1, 2, 8, 9]
-    print('weathers = ')
-    print(weathers)
-
-    with make_carla_client(args.host, args.port) as client:
-        print('CarlaClient connected')
-
-        # scene = client.load_settings(new_setting())
-
-        # Choose one player start at random.
-        number_of_player_starts = 152
-
-        print('%d - %d episodes will be generated...' % (args.i_start, args.i_end))
-
-        startPoints = list(range(args.i_start, args.i_end))
-        # startPoints = random.sample(startPoints, number_of_episodes)
-
-        # Create a CarlaSettings object. This object is a wrapper around
-        # the CarlaSettings.ini file. Here we set the configuration we
-        # want for the new episode.
-        settings = CarlaSettings()
-        settings.set(
-            SynchronousMode=True,
-            SendNonPlayerAgentsInfo=True,
-            NumberOfVehicles=40,
-            NumberOfPedestrians=40,
-            WeatherId=random.choice(weathers),
-            QualityLevel=args.quality_level)
-        settings.randomize_seeds()
-
-        # Now we want to add a couple of cameras to the player vehicle.
-        # We will collect the images produced by these cameras every
-        # frame.
-
-        for cameraID, camcoor_y in zip(range(2, 4), camcoor_ys):
-            # The default camera captures RGB images of the scene.
-            cameraRGB = Camera('Camera%dRGB' % cameraID, FOV=camFOV)
-            # Set image resolution in pixels.
-            cameraRGB.set_image_size(resolution_w, resolution_h)
-            # Set its position relative to the car in meters.
-            cameraRGB.set_position(camcoor_x, camcoor_y, camcoor_z)
-            settings.add_sensor(cameraRGB)
-
-            # Let's add another camera producing ground-truth depth.
-            cameraDepth = Camera('Camera%dDepth' % cameraID, PostProcessing='Depth', FOV=camFOV)
-            cameraDepth.set_image_size(resolution_w, resolution_h)
-            cameraDepth.set_position(camcoor_x, camcoor_y, camcoor_z)
-            settings.add_sensor(cameraDepth)
-
-        for episode, startPoint in enumerate(startPoints):
-
-            def generateFrom(startPoint):
-                settings.set(WeatherId=random.choice(weathers))
-                # Start a new episode.
-                scene = client.load_settings(settings)
-                print('Starting new episode at %r...' % scene.map_name)
-                client.start_episode(startPoint)
-
-                ticLeft = time.time()
-                ticTimeOut = ticLeft
-                # Iterate every frame in the episode.
-                iGlobalFrame = 0
-                iframe = 0
-
-                while True:
-                    # Read the data produced by the server this frame.
-                    measurements, sensor_data = client.read_data()
+    def disparity(depth):
+        return camfu * cambaseline / depth
 
-                    # Print some of the measurements.
-                    print_measurements(measurements)
+    # raw capture defers all conversions to convert_raw.py
+    capture = RawCaptureWriter(args.output_folder, args.frames_per_episode, metadata=dict(
+        camfu=camfu, cambaseline=cambaseline, depth_format=args.depth_format,
+        max_depth=args.max_depth, warp_right_depth=args.warp_right_depth)) if args.raw else None
 
-
-                    if measurements.player_measurements.forward_speed * 3.6 > 15:
-                        iGlobalFrame += 1
-                        if iGlobalFrame % args.period == 0:
-                            # Save the images to disk.
-                            for name, measurement in sensor_data.items():
-                                filename = args.out_filename_format.format(startPoint, name, iframe)
-                                measurement.save_to_disk(filename, lambda depth: camfu * cambaseline / depth, 'pfm')
-                            iframe += 1
+    try:
+        # weather settings
+        weathers = [1, 2, 8, 9]
+        print('weathers = ')
+        print(weathers)
+
+        with make_carla_client(args.host, args.port) as client:
+            print('CarlaClient connected')
+
+            # scene = client.load_settings(new_setting())
+
+            # Choose one player start at random.
+            number_of_player_starts = 152
+
+            print('%d - %d episodes will be generated...' % (args.i_start, args.i_end))
+
+            startPoints = list(range(args.i_start, args.i_end))
+            # startPoints = random.sample(startPoints, number_of_episodes)
+
+            # Create a CarlaSettings object. This object is a wrapper around
+            # the CarlaSettings.ini file. Here we set the configuration we
+            # want for the new episode.
+            settings = CarlaSettings()
+            settings.set(
+                SynchronousMode=True,
+                SendNonPlayerAgentsInfo=True,
+                NumberOfVehicles=40,
+                NumberOfPedestrians=40,
+                WeatherId=random.choice(weathers),
+                QualityLevel=args.quality_level)
+            settings.randomize_seeds()
+
+            # Now we want to add a couple of cameras to the player vehicle.
+            # We will collect the images produced by these cameras every
+            # frame.
+
+            cameras = {}
+            for cameraID, camcoor_y in zip(range(2, 4), camcoor_ys):
+                # The default camera captures RGB images of the scene.
+                cameraRGB = Camera('Camera%dRGB' % cameraID, FOV=camFOV)
+                # Set image resolution in pixels.
+                cameraRGB.set_image_size(resolution_w, resolution_h)
+                # Set its position relative to the car in meters.
+                cameraRGB.set_position(camcoor_x, camcoor_y, camcoor_z)
+                settings.add_sensor(cameraRGB)
+                cameras[cameraRGB.SensorName] = cameraRGB
+
+                # Let's add another camera producing ground-truth depth.
+                cameraDepth = Camera('Camera%dDepth' % cameraID, PostProcessing='Depth', FOV=camFOV)
+                cameraDepth.set_image_size(resolution_w, resolution_h)
+                cameraDepth.set_position(camcoor_x, camcoor_y, camcoor_z)
+                if cameraID == 2 or not args.warp_right_depth:
+                    settings.add_sensor(cameraDepth)
+                cameras[cameraDepth.SensorName] = cameraDepth
+
+                if args.segmentation:
+                    # Semantic segmentation labels, saved as single channel png.
+                    cameraSeg = Camera('Camera%dSeg' % cameraID, PostProcessing='SemanticSegmentation', FOV=camFOV)
+                    cameraSeg.set_image_size(resolution_w, resolution_h)
+                    cameraSeg.set_position(camcoor_x, camcoor_y, camcoor_z)
+                    settings.add_sensor(cameraSeg)
+                    cameras[cameraSeg.SensorName] = cameraSeg
+
+            # outputs derived from the depth maps in meters
+            right_depth_needed = args.occlusion or args.disp_change or bool(args.pyramid)
+            left_depth_needed = right_depth_needed or args.warp_right_depth or args.labels or args.flow or \
+                args.normals or args.bev is not None
+
+            # KITTI label_2 files of the left camera
+            label_generator = LabelGenerator(cameras['Camera2RGB']) if args.labels else None
+            # bird's-eye view of the left depth point-cloud, in the vehicle frame
+            bev_rasterizer = BevRasterizer() if args.bev else None
+            left_to_car = Transform(matrix=numpy.linalg.inv(car_to_camera(cameras['Camera2Depth'])))
+
+            for episode, startPoint in enumerate(startPoints):
+
+                def generateFrom(startPoint):
+                    settings.set(WeatherId=random.choice(weathers))
+                    # Start a new episode.
+                    scene = client.load_settings(settings)
+                    print('Starting new episode at %r...' % scene.map_name)
+                    client.start_episode(startPoint)
+
+                    sink.begin_episode(EPISODE_FORMAT.format(startPoint))
+                    if capture is not None:
+                        capture.begin_episode(startPoint)
+                    agent_log = AgentLog() if args.agent_log else None
+                    pose_recorder = PoseRecorder() if args.poses else None
+                    flow_generator = FlowGenerator(cameras['Camera2RGB']) if args.flow else None
+                    # pixels per class of the segmentation cameras, computed by convert_raw.py under --raw
+                    class_histograms = {} if capture is not None else dict(
+                        (name, numpy.zeros(SEGMENTATION_CLASSES, dtype=numpy.int64))
+                        for name in cameras if name.endswith('Seg'))
+                    disp_change_generators = dict(
+                        (name, DisparityChangeGenerator(cameras[name + 'Depth'], cambaseline))
+                        for name in ('Camera2', 'Camera3')) if args.disp_change else {}
+
+                    ticLeft = time.time()
+                    ticTimeOut = ticLeft
+                    # Iterate every frame in the episode.
+                    iGlobalFrame = 0
+                    iframe = 0
+
+                    while True:
+                        # Read the data produced by the server this frame.
+                        measurements, sensor_data = client.read_data()
+
+                        # Print some of the measurements.
+                        print_measurements(measurements)
+
+
+                        if measurements.player_measurements.forward_speed * 3.6 > 15:
+                            iGlobalFrame += 1
+                            if iGlobalFrame % args.period == 0:
+                                agents = extract_agents(measurements, iframe) if agent_log is not None \
+                                    or label_generator is not None or flow_generator is not None \
+                                    or disp_change_generators else None
+                                if capture is not None:
+                                    # Copy the raw images, convert them later.
+                                    capture.write(iframe, measurements, sensor_data)
+                                else:
+                                    player_transform = measurements.player_measurements.transform
+                                    # Depth maps in meters, decoded once and only for the derived outputs.
+                                    depths = {}
+                                    # left disparity warped to the right view, if already computed
+                                    warp = None
+                                    if left_depth_needed:
+                                        depths['Camera2'] = sensor_data['Camera2Depth'].data * FAR_DEPTH
+                                    if args.warp_right_depth:
+                                        # Right depth warped from the left one, holes flagged separately.
+                                        right = WarpedDepth(depths['Camera2'], camfu * cambaseline)
+                                        sink.save(KEY_FORMAT.format(startPoint, 'Camera3Depth', iframe), right,
+                                                  disparity, args.depth_format, args.max_depth)
+                                        extension, payload = encode_mask(right.holes)
+                                        sink.add(KEY_FORMAT.format(startPoint, 'Camera3Holes', iframe) + extension,
+                                                 payload)
+                                        depths['Camera3'] = right.depth
+                                        warp = right.warp
+                                    elif right_depth_needed:
+                                        depths['Camera3'] = sensor_data['Camera3Depth'].data * FAR_DEPTH
+                                    # Save the images through the sink.
+                                    for name, measurement in sensor_data.items():
+                                        if name.endswith('Depth') and name[:-len('Depth')] in depths:
+                                            measurement = DepthMap(depths[name[:-len('Depth')]])
+                                        sink.save(KEY_FORMAT.format(startPoint, name, iframe), measurement,
+                                                  disparity, args.depth_format, args.max_depth)
+                                    depth = depths.get('Camera2')
+                                    if label_generator is not None:
+                                        labels = label_generator.generate(agents, player_transform, depth)
+                                        extension, payload = encode_labels(labels)
+                                        sink.add(KEY_FORMAT.format(startPoint, 'Camera2Label', iframe) + extension,
+                                                 payload)
+                                    if flow_generator is not None:
+                                        # Flow from the previous saved frame to this one.
+                                        flow = flow_generator.update(depth, player_transform, agents)
+                                        if flow is not None:
+                                            extension, payload = encode_kitti_flow(*flow)
+                                            sink.add(KEY_FORMAT.format(startPoint, 'Camera2Flow', iframe - 1) +
+                                                     extension, payload)
+                                    if args.normals:
+                                        extension, payload = encode_normals(*surface_normals(
+                                            depth, intrinsics_from_camera(cameras['Camera2Depth'])))
+                                        sink.add(KEY_FORMAT.format(startPoint, 'Camera2Normal', iframe) + extension,
+                                                 payload)
+                                    if bev_rasterizer is not None:
+                                        points = back_project(depth, intrinsics_from_camera(cameras['Camera2Depth']))
+                                        point_cloud = PointCloud(iframe, points[depth < FAR_DEPTH])
+                                        extension, payload = bev_rasterizer.encode(
+                                            bev_rasterizer.rasterize(point_cloud, left_to_car), args.bev)
+                                        sink.add(KEY_FORMAT.format(startPoint, 'Camera2BEV', iframe) + extension,
+                                                 payload)
+                                    if args.occlusion:
+                                        masks = occlusion_masks(
+                                            disparity(depth), disparity(depths['Camera3']), warp=warp)
+                                        for name, mask in zip(('Camera2Occlusion', 'Camera3Occlusion'), masks):
+                                            extension, payload = encode_mask(mask)
+                                            sink.add(KEY_FORMAT.format(startPoint, name, iframe) + extension,
+                                                     payload)
+                                    if args.pyramid:
+                                        # Downsampled levels from the already decoded images.
+                                        arrays = dict((name, (image.type, image.data))
+                                                      for name, image in sensor_data.items())
+                                        arrays.update((name + 'Depth', ('Depth', depth))
+                                                      for name, depth in depths.items())
+                                        for name, (image_type, array) in arrays.items():
+                                            for level in build_pyramid(image_type, array, args.pyramid):
+                                                level_name = '%s_s%d' % (name, level.factor)
+                                                sink.save(KEY_FORMAT.format(startPoint, level_name, iframe), level,
+                                                          disparity, args.depth_format, args.max_depth)
+                                    for name, generator in disp_change_generators.items():
+                                        # Disparity change from the previous saved frame to this one.
+                                        change = generator.update(depths[name], player_transform, agents)
+                                        if change is not None:
+                                            extension, payload = encode_pfm(change)
+                                            sink.add(KEY_FORMAT.format(startPoint, name + 'DispChange', iframe - 1) +
+                                                     extension, payload)
+                                    sink.commit()
+                                for name, histogram in class_histograms.items():
+                                    histogram += class_histogram(sensor_data[name])
+                                if agent_log is not None:
+                                    agent_log.append(agents)
+                                if pose_recorder is not None:
+                                    pose_recorder.append(measurements, iframe)
+                                iframe += 1
+                                ticTimeOut = time.time()
+                                print('time left: %.2f' % ((time.time() - ticLeft) / 3600 * (
+                                        (args.frames_per_episode - iframe)
+                                        + args.frames_per_episode * (len(startPoints) - episode - 1)))
+                                      )
+                                ticLeft = time.time()
+
+
+                        control = measurements.player_measurements.autopilot_control
+                        control.steer += random.uniform(-0.02, 0.02)
+                        client.send_control(control)
+
+                        if iframe >= args.frames_per_episode:
+                            episode_key = EPISODE_FORMAT.format(startPoint) + '/'
+                            if agent_log is not None:
+                                agent_log.save(sink, episode_key + 'agents')
+                            for name, histogram in class_histograms.items():
+                                buffer = io.BytesIO()
+                                numpy.save(buffer, histogram)
+                                sink.add(episode_key + name + '_histogram.npy', buffer.getvalue())
+                            if pose_recorder is not None:
+                                # Poses of the left camera relative to the first frame.
+                                sink.save(episode_key + 'poses', pose_recorder)
+                                extension, payload = encode_kitti_poses(
+                                    kitti_poses(pose_recorder.array, cameras['Camera2RGB']))
+                                sink.add(episode_key + 'poses' + extension, payload)
+                            sink.commit()
+                            return True
+                        # if time out, something might be wrong with the auto pilot control
+                        if time.time() - ticTimeOut > 120:
+                            print('Time out! Something might be wrong with the auto pilot control!')
                             ticTimeOut = time.time()
-                            print('time left: %.2f' % ((time.time() - ticLeft) / 3600 * (
-                                    (args.frames_per_episode - iframe)
-                                    + args.frames_per_episode * (len(startPoints) - episode - 1)))
-                                  )
-                            ticLeft = time.time()
+                            return False
 
 
-                    control = measurements.player_measurements.autopilot_control
-                    control.steer += random.uniform(-0.02, 0.02)
-                    client.send_control(control)
-
-                    if iframe >= args.frames_per_episode:
-                        return True
-                    # if time out, something might be wrong with the auto pilot control
-                    if time.time() - ticTimeOut > 120:
-                        print('Time out! Something might be wrong with the auto pilot control!')
-                        ticTimeOut = time.time()
-                        return False
-
-
-            while True:
-                # if timeout happens, regenerate from current start point
-                if generateFrom(startPoint):
-                    break
-                else:
-                    print('Warning: Timeout happened, regenerating from current start point %d' % startPoint)
+                while True:
+                    # if timeout happens, regenerate from current start point
+                    if generateFrom(startPoint):
+                        break
+                    else:
+                        print('Warning: Timeout happened, regenerating from current start point %d' % startPoint)
+                sink.end_episode()
+                if capture is not None:
+                    capture.end_episode()
+    finally:
+        # Also on errors (e.g. a lost connection), before main retries.
+        if capture is not None:
+            capture.close()
+        sink.rollback()
 
 
 def print_measurements(measurements):
@@ -193,6 +363,97 @@ def main():
         default=2,
         type=float,
         help='scale of frames')
+    argparser.add_argument(
+        '--depth_format',
+        choices=['pfm', 'kitti'],
+        default='pfm',
+        help='format of disparity maps: float32 pfm or KITTI uint16 png (disparity * 256, 0 for invalid)')
+    argparser.add_argument(
+        '--max_depth',
+        default=None,
+        type=float,
+        help='pixels farther than max_depth (in meters) are marked invalid in KITTI disparity maps '
+             '(default: only sky is invalid)')
+    argparser.add_argument(
+        '--sink',
+        choices=SINKS,
+        default='files',
+        help='where frames go: files (one file per frame), shards (tar shards with an offset index), '
+             'memory (ring buffer of the last frames), null (encode and discard), drop (discard unencoded)')
+    argparser.add_argument(
+        '--shards',
+        action='store_const',
+        const='shards',
+        dest='sink',
+        help='same as --sink shards')
+    argparser.add_argument(
+        '--shard_size',
+        default=1024,
+        type=int,
+        help='maximum size of a tar shard in MB (sink shards)')
+    argparser.add_argument(
+        '--raw',
+        action='store_true',
+        help='capture raw images and measurements to per-episode memory-mapped files, '
+             'convert them afterwards with convert_raw.py (only with --sink files)')
+    argparser.add_argument(
+        '--pyramid',
+        default=[],
+        type=lambda factors: [int(factor) for factor in factors.split(',')],
+        help='comma separated downsampling factors, e.g. 2,4, every camera is also written downsampled '
+             'to episode_[i]/Camera[2/3][RGB/Depth]_s[factor] (ignored with --raw)')
+    argparser.add_argument(
+        '--segmentation',
+        action='store_true',
+        help='add semantic segmentation cameras Camera[2/3]Seg saved as single channel png, '
+             'with the pixels per class of every episode in episode_[i]/Camera[2/3]Seg_histogram.npy')
+    argparser.add_argument(
+        '--warp_right_depth',
+        action='store_true',
+        help='do not render Camera3Depth, warp Camera2Depth to the right view instead and flag '
+             'the disoccluded pixels in episode_[i]/Camera3Holes as bit-packed npy')
+    argparser.add_argument(
+        '--agent_log',
+        action='store_true',
+        help='log the non-player agents of every saved frame to per-episode columnar files')
+    argparser.add_argument(
+        '--poses',
+        action='store_true',
+        help='record the player pose of every saved frame to episode_[i]/poses.npy '
+             'and the KITTI odometry poses of the left camera to episode_[i]/poses.txt')
+    argparser.add_argument(
+        '--labels',
+        action='store_true',
+        help='write KITTI label_2 files of the vehicles and pedestrians visible from the left camera '
+             'to episode_[i]/Camera2Label (ignored with --raw)')
+    argparser.add_argument(
+        '--flow',
+        action='store_true',
+        help='write the optical flow of the left camera from every saved frame to the next one '
+             'to episode_[i]/Camera2Flow as KITTI 16-bit png, pixels on moving agents are invalid '
+             '(ignored with --raw)')
+    argparser.add_argument(
+        '--disp_change',
+        action='store_true',
+        help='write the SceneFlow disparity change of both cameras from every saved frame to the next one '
+             'to episode_[i]/Camera[2/3]DispChange as pfm, NaN on invalid pixels and moving agents '
+             '(ignored with --raw)')
+    argparser.add_argument(
+        '--normals',
+        action='store_true',
+        help='write the surface normals of the left camera computed from depth to episode_[i]/Camera2Normal '
+             'as png (ignored with --raw)')
+    argparser.add_argument(
+        '--bev',
+        choices=['uint8', 'float16'],
+        default=None,
+        help="write the bird's-eye view occupancy, max height and density of the left depth point-cloud "
+             'to episode_[i]/Camera2BEV as a (3, 704, 800) npy tensor of this type (ignored with --raw)')
+    argparser.add_argument(
+        '--occlusion',
+        action='store_true',
+        help='write the left-right occlusion masks of both cameras to episode_[i]/Camera[2/3]Occlusion '
+             'as bit-packed npy (ignored with --raw)')
     argparser.add_argument(
         '--i_end',
         default=0,
@@ -215,25 +476,28 @@ def main():
         help='number of frames between every saving event')
 
     args = argparser.parse_args()
+    if args.raw and args.sink != 'files':
+        # convert_raw.py copies the episode-level files (poses, agent log) from the output folder.
+        argparser.error('--raw needs --sink files, not --sink %s' % args.sink)
 
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)
 
     logging.info('listening to server %s:%s', args.host, args.port)
 
-    args.out_filename_format = os.path.join(args.output_folder, 'episode_{:0>4d}/{:s}/{:0>6d}')
-
-    while True:
-        try:
+    # output settings, kept across reconnections
+    with make_sink(args.sink, args.output_folder, max_shard_size=args.shard_size << 20) as sink:
+        while True:
+            try:
 
-            run_carla_client(args)
+                run_carla_client(args, sink)
 
-            print('Done.')
-            return
+                print('Done.')
+                return
 
-        except TCPConnectionError as error:
-            logging.error(error)
-            time.sleep(1)
+            except TCPConnectionError as error:
+                logging.error(error)
+                time.sleep(1)
 
 
 if __name__ == '__main__':
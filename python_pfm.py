@@ -5,7 +5,9 @@ import sys
 
 
 def readPFM(file):
-    file = open(file, 'rb')
+    # changes made to accept file objects
+    if not hasattr(file, 'read'):
+        file = open(file, 'rb')
 
     color = None
     width = None
@@ -36,7 +38,7 @@ def readPFM(file):
     else:
         endian = '>'  # big-endian
 
-    data = np.fromfile(file, endian + 'f')
+    data = np.frombuffer(bytearray(file.read()), endian + 'f')
     shape = (height, width, 3) if color else (height, width)
 
     data = np.reshape(data, shape)
@@ -45,7 +47,9 @@ def readPFM(file):
 
 
 def writePFM(file, image, scale=1):
-    file = open(file, 'wb')
+    # changes made to accept file objects
+    if not hasattr(file, 'write'):
+        file = open(file, 'wb')
 
     color = None
 
@@ -73,4 +77,4 @@ def writePFM(file, image, scale=1):
 
     file.write(bytes('%f\n' % scale, encoding = "utf8"))
 
-    image.tofile(file)
+    file.write(image.tobytes())
@@ -0,0 +1,45 @@
+import numpy
+
+from carla.archive import KEY_FORMAT, ShardReader, ShardWriter
+from carla.bev import Bev, BevRasterizer
+from carla.flow import decode_kitti_flow, encode_kitti_flow
+from carla.stereo import encode_mask, unpack_mask
+
+
+def test_flow_round_trip(tmpdir):
+    random = numpy.random.RandomState(0)
+    # Multiples of 1/64, the KITTI flow resolution, round trip exactly.
+    flow = random.randint(-6400, 6400, (6, 9, 2)).astype(numpy.float32) / 64.0
+    valid = random.rand(6, 9) > 0.3
+    extension, payload = encode_kitti_flow(flow, valid)
+    with ShardWriter(str(tmpdir)) as writer:
+        writer.add(KEY_FORMAT.format(0, 'Camera2Flow', 0) + extension, payload)
+
+    with ShardReader(str(tmpdir)) as reader:
+        array = reader.read(0, 'Camera2Flow', 0)
+    assert array.dtype == numpy.uint16 and array.shape == (6, 9, 3)
+    decoded, decoded_valid = decode_kitti_flow(payload)
+    numpy.testing.assert_array_equal(array[:, :, 2] > 0, decoded_valid)
+    numpy.testing.assert_array_equal(decoded_valid, valid)
+    numpy.testing.assert_array_equal(decoded[valid], flow[valid])
+    numpy.testing.assert_array_equal((array[:, :, :2][valid] - 32768.0) / 64.0, flow[valid])
+
+
+def test_npy_and_txt_round_trip(tmpdir):
+    mask = numpy.random.rand(5, 13) > 0.5
+    rasterizer = BevRasterizer(x_range=(0.0, 1.0), y_range=(0.0, 2.0), resolution=0.5)
+    bev = Bev(numpy.ones((2, 4), dtype=bool), numpy.zeros((2, 4), dtype=numpy.float32),
+              numpy.ones((2, 4), dtype=numpy.uint32))
+    text = b'Car 0.00 0 -1.57 10.00 20.00 30.00 40.00 1.50 1.60 3.90 1.00 1.60 10.00 0.00\n'
+    members = [('Camera2Occlusion', encode_mask(mask)), ('Camera2BEV', rasterizer.encode(bev)),
+               ('Camera2Label', ('.txt', text))]
+    with ShardWriter(str(tmpdir)) as writer:
+        for name, (extension, payload) in members:
+            writer.add(KEY_FORMAT.format(1, name, 2) + extension, payload)
+
+    with ShardReader(str(tmpdir)) as reader:
+        numpy.testing.assert_array_equal(unpack_mask(reader.read(1, 'Camera2Occlusion', 2), 13), mask)
+        tensor = reader.read(1, 'Camera2BEV', 2)
+        assert tensor.dtype == numpy.uint8 and tensor.shape == (3, 2, 4)
+        numpy.testing.assert_array_equal(tensor[0], 255)
+        assert reader.read(1, 'Camera2Label', 2) == text